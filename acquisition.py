@@ -0,0 +1,355 @@
+import os
+import sys
+import time
+import zlib
+import json
+import queue
+import asyncio
+import threading
+import itertools
+import concurrent.futures
+from enum import Enum
+
+from typing import Callable
+
+import numpy as np
+import usb.core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from owonPDS6062T import OwonPDS6062T
+from measurements import measure_frame, screen_duration
+
+SCREEN_POINTS=1520
+DEFAULT_HEADER_POLL_INTERVAL=1.0
+# s ... frames are polled once per screen duration given by the timebase, but at least this often
+DEFAULT_MAX_POLL_INTERVAL=0.25
+# s ... frame equal to the previous one is delivered only this often (0 delivers all frames)
+DEFAULT_KEEPALIVE_INTERVAL=1.0
+
+class ACQ_MODES(Enum):
+    SCREEN = 'screen' # HEAD?, CH1?, CH2? transaction per frame
+    DEPMEM = 'depmem' # single DEPMem:All? transaction per frame
+
+class CMD_PRIORITIES(Enum):
+    # lower value is executed first; frame acquisition runs only when no command is pending
+    WRITE = 0
+    QUERY = 1
+
+class Frame:
+    '''
+    single capture of the oscilloscope screen
+
+    seq - monotonic sequence number of the frame delivered by the worker (None for frame read otherwise, e.g. for measurements)
+    header - HEAD response (including 4B length) valid for the channels data
+    header_id - incremented whenever the header content changes
+    header_changed - header differs from the previous frame (or was requested to be resent)
+    channels - {channel: 8-bit samples} of the displayed channels
+    t_start, t_end - wall clock time of the acquisition start and end
+    decoded_header - header json
+    '''
+    def __init__(self, seq: int, header: bytes, header_id: int, header_changed: bool, channels: dict, t_start: float, t_end: float, decoded_header: dict = None):
+        self.seq = seq
+        self.header = header
+        self.header_id = header_id
+        self.header_changed = header_changed
+        self.channels = channels
+        self.t_start = t_start
+        self.t_end = t_end
+        self.decoded_header = decoded_header
+        self.encoded = {} # cache of messages the frame is encoded to (cf. relay_srv.encode_frame())
+        self._measurements = None
+
+    @property
+    def measurements(self) -> dict:
+        '''
+        {channel: measurements} computed on first use (cf. measurements.measure_frame())
+        '''
+        if self._measurements is None:
+            self._measurements = measure_frame(self.decoded_header, self.channels) if self.decoded_header else {}
+        return self._measurements
+
+def peak_decimate(samples: np.ndarray, points: int) -> np.ndarray:
+    '''
+    reduces samples to points by keeping minimum and maximum of each of points//2 buckets in the order they occur,
+    so glitches and peaks survive the decimation (picking every n-th sample would drop them)
+    '''
+    buckets = max(1, points//2)
+    size = -(-len(samples)//buckets)
+    # the last bucket is padded by its last sample ... no new extreme is introduced
+    grid = np.pad(samples, (0, size*buckets-len(samples)), mode='edge').reshape(buckets, size)
+    lo, hi = grid.argmin(axis=1), grid.argmax(axis=1)
+    rows = np.arange(buckets)
+    decimated = np.stack([grid[rows, np.minimum(lo, hi)], grid[rows, np.maximum(lo, hi)]], axis=1).ravel()
+    return np.append(decimated, samples[-1]) if points % 2 else decimated
+
+class AcquisitionWorker(threading.Thread):
+    '''
+    owns the oscilloscope: reads frames in its own thread and executes queued commands in between them,
+    so that the USB I/O never blocks the asyncio loop
+
+    finished frames are passed to the asyncio loop through the bounded `frames` queue
+    '''
+    def __init__(self, usb_find=None, acq_mode: ACQ_MODES = ACQ_MODES.SCREEN, header_poll_interval: float = DEFAULT_HEADER_POLL_INTERVAL, serial: str = None, bus: int = None, address: int = None,
+            max_poll_interval: float = DEFAULT_MAX_POLL_INTERVAL, keepalive_interval: float = DEFAULT_KEEPALIVE_INTERVAL):
+        '''
+        header_poll_interval - seconds between HEAD? polls in SCREEN mode (settings may be changed by buttons on the
+            oscilloscope); the header is re-read immediately after any write command, 0 polls it with every frame
+        max_poll_interval - cap of the interval between frames derived from the timebase (cf. poll_interval()), 0 polls as fast as possible
+        keepalive_interval - frames with the same header and channels data as the previously delivered one are skipped
+            unless this many seconds elapsed (sequence numbers are assigned to the delivered frames only), 0 delivers all frames
+        serial, bus, address - oscilloscope to be used when several are connected (cf. OwonPDS6062T.find())
+        '''
+        super().__init__(name=' '.join(['acquisition']+[str(v) for v in (serial, bus, address) if v is not None]), daemon=True)
+        self.usb_find = usb_find if usb_find else usb.core.find
+        self.acq_mode = acq_mode
+        self.header_poll_interval = header_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.keepalive_interval = keepalive_interval
+        self.selector = {'serial': serial, 'bus': bus, 'address': address}
+        self.o = self._connect()
+        self._active = False
+        self.frames = None
+        self.loop = None
+        self.last_header = None
+        self.header_id = 0
+        self.decoded_header = None
+        self.displayed_channels = {}
+        self.last_frame = None
+        # optional callback(cmd, timing) invoked after each USB transaction (cf. OwonPDS6062T.on_timing)
+        self.on_timing = None
+        self.reconnects = 0
+        self.failed_frames = 0
+        self.skipped_frames = 0
+        self._channel_hashes = {}
+        self._delivered_at = 0.0
+        self._next_poll = 0.0
+        self._header_requested = True
+        self._header_stale = True
+        self._header_polled_at = 0.0
+        self._commands = queue.PriorityQueue()
+        self._cmd_seq = itertools.count()
+        self._frame_seq = itertools.count()
+        self._stop_evt = threading.Event()
+
+    def _connect(self) -> OwonPDS6062T:
+        o = OwonPDS6062T(usb_find=self.usb_find, **self.selector)
+        o.on_timing = self._on_timing
+        return o
+
+    def _on_timing(self, cmd, timing: dict):
+        if self.on_timing:
+            self.on_timing(cmd, timing)
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop if loop else asyncio.get_running_loop()
+        self.frames = asyncio.Queue(maxsize=1)
+        super().start()
+
+    def stop(self):
+        self._stop_evt.set()
+        self._wake_up()
+
+    def _wake_up(self):
+        self._commands.put((-1, -1, None, None))
+
+    @property
+    def active(self) -> bool:
+        '''
+        frames are acquired only while somebody is interested in them
+        '''
+        return self._active
+
+    @active.setter
+    def active(self, value: bool):
+        was_active = self._active
+        self._active = value
+        if value and not was_active:
+            self._wake_up()
+
+    def request_header(self):
+        '''
+        next frame is marked header_changed (e.g. for a newly connected client)
+        '''
+        self._header_requested = True
+
+    def invalidate_header(self):
+        '''
+        cached header is re-read with the next frame
+        '''
+        self._header_stale = True
+
+    def submit(self, fn: Callable[[OwonPDS6062T], object], priority: CMD_PRIORITIES = CMD_PRIORITIES.QUERY) -> concurrent.futures.Future:
+        '''
+        schedule fn(oscilloscope) to be executed by the worker between frames
+        '''
+        fut = concurrent.futures.Future()
+        self._commands.put((priority.value, next(self._cmd_seq), fn, fut))
+        return fut
+
+    async def call(self, fn: Callable[[OwonPDS6062T], object], priority: CMD_PRIORITIES = CMD_PRIORITIES.QUERY):
+        return await asyncio.wrap_future(self.submit(fn, priority))
+
+    def poll_interval(self) -> float:
+        '''
+        screen content does not change faster than the screen is swept (unless in roll mode, hence the cap)
+        '''
+        if not self.max_poll_interval or not self.decoded_header:
+            return 0.0
+        try:
+            return min(self.max_poll_interval, screen_duration(self.decoded_header))
+        except Exception:
+            # unknown timebase format
+            return 0.0
+
+    def is_unchanged(self, frame: Frame) -> bool:
+        '''
+        frame carries the same data as the previous one (compared by hashes of the channels)
+        '''
+        hashes = {ch: zlib.crc32(data) for ch, data in frame.channels.items()}
+        unchanged = hashes == self._channel_hashes and not frame.header_changed
+        self._channel_hashes = hashes
+        return unchanged
+
+    def run(self):
+        last_presence_check = time.monotonic()
+        while not self._stop_evt.is_set():
+            if self.o is None:
+                self._reconnect()
+                continue
+            try:
+                # commands are executed while waiting for the next poll
+                self._run_commands(self._next_poll if self.active else time.monotonic()+0.5)
+                if self.active and not self._stop_evt.is_set() and time.monotonic() >= self._next_poll:
+                    t_poll = time.monotonic()
+                    frame = self.read_frame()
+                    self._next_poll = t_poll + self.poll_interval()
+                    if (self.keepalive_interval and self.is_unchanged(frame) and
+                            time.monotonic() - self._delivered_at < self.keepalive_interval):
+                        self.skipped_frames += 1
+                    else:
+                        self._delivered_at = time.monotonic()
+                        # gaps in sequence numbers mean dropped frames for clients
+                        frame.seq = next(self._frame_seq)
+                        self._deliver(frame)
+                if time.monotonic() - last_presence_check > 1:
+                    last_presence_check = time.monotonic()
+                    if not OwonPDS6062T.find(self.usb_find, bus=self.o._dev.bus, address=self.o._dev.address):
+                        raise usb.core.USBError('oscilloscope disconnected')
+            except usb.core.USBError as err:
+                print(f'> USB error: {err}')
+                self.o = None
+            except Exception as err:
+                # e.g. data lengths mismatch ... the frame is read again
+                self.failed_frames += 1
+                print(f'> acquisition failed: {err}')
+
+    def _run_commands(self, until: float):
+        '''
+        executes all pending commands and those coming until the monotonic time `until` (or until woken up)
+        '''
+        while True:
+            timeout = until - time.monotonic()
+            try:
+                priority, _, fn, fut = self._commands.get(block=timeout > 0, timeout=max(0, timeout))
+            except queue.Empty:
+                return
+            if fn is None:
+                # woken up (e.g. became active)
+                return
+            if not fut.set_running_or_notify_cancel():
+                continue
+            if priority == CMD_PRIORITIES.WRITE.value:
+                # settings are likely to change ... show them without waiting for the next poll
+                self.invalidate_header()
+                self._next_poll = 0.0
+            try:
+                fut.set_result(fn(self.o))
+            except usb.core.USBError as err:
+                fut.set_exception(err)
+                raise
+            except Exception as err:
+                fut.set_exception(err)
+
+    def _reconnect(self):
+        print('> waiting for oscilloscope to be reconnected')
+        while not self._stop_evt.is_set():
+            # commands cannot wait for the reconnection
+            while not self._commands.empty():
+                _, _, fn, fut = self._commands.get()
+                if fn is not None and fut.set_running_or_notify_cancel():
+                    fut.set_exception(usb.core.USBError('oscilloscope not connected'))
+            try:
+                self.o = self._connect()
+                self.reconnects += 1
+                self.request_header()
+                self.invalidate_header()
+                print('> oscilloscope reconnected')
+                return
+            except Exception:
+                self._stop_evt.wait(1)
+
+    def _deliver(self, frame: Frame):
+        put = self.frames.put(frame)
+        try:
+            fut = asyncio.run_coroutine_threadsafe(put, self.loop)
+        except RuntimeError:
+            # loop is closed ... nobody to deliver to
+            put.close()
+            self._stop_evt.set()
+            return
+        while not self._stop_evt.is_set():
+            try:
+                return fut.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                pass
+        fut.cancel()
+
+    def _read_depmem(self):
+        '''
+        returns HEAD response (with 4B length) and {channel: 8-bit samples} within single USB transaction
+        '''
+        header, channels = self.o.parse_depmem_all(self.o._send(':DATA:WAVE:DEPMem:All?'))
+        header = len(header).to_bytes(4, 'little')+header
+        screen_points = self.decoded_header.get('SAMPLE', {}).get('FULLSCREEN', SCREEN_POINTS) if self.decoded_header else SCREEN_POINTS
+        for ch, data in channels.items():
+            samples = data[1::2] # 8-bit only ... zero-copy view skipping byte that is always 0 within each sample
+            if len(samples) > screen_points:
+                # deep memory holds more points than the screen ... decimate so that clients get the screen width
+                samples = peak_decimate(np.frombuffer(samples, dtype=np.int8), screen_points).data
+            elif len(samples) < screen_points:
+                samples = np.frombuffer(samples, dtype=np.int8)[np.linspace(0, len(samples)-1, screen_points).astype(np.intp)].data
+            channels[ch] = samples
+        return header, channels
+
+    def read_frame(self) -> Frame:
+        t_start = time.time()
+        if self.acq_mode == ACQ_MODES.DEPMEM:
+            header, channels = self._read_depmem()
+        elif self._header_stale or time.monotonic()-self._header_polled_at >= self.header_poll_interval:
+            self._header_stale = False
+            self._header_polled_at = time.monotonic()
+            header, channels = self.o._send(':DATA:WAVE:SCREen:HEAD?'), None
+        else:
+            # settings were not changed via the relay ... cached header is still valid
+            header, channels = self.last_header, None
+        header_changed = self.last_header != header or self._header_requested
+        if header_changed:
+            if self.last_header != header:
+                self.header_id += 1
+            self._header_requested = False
+            self.last_header = bytes(header) # header is a view on the receive buffer reused by the next read
+            self.decoded_header = json.loads(self.last_header[4:].decode('utf-8').strip())
+            self.displayed_channels = { int(x['NAME'][-1]) : x['DISPLAY'] for x in self.decoded_header['CHANNEL'] }
+        frame_channels = {}
+        for ch in range(1,3):
+            if self.displayed_channels[ch] == 'OFF':
+                continue
+            if channels is None:
+                chan_data=self.o._send(':DATA:WAVE:SCREen:CH{}?'.format(ch))
+                rawdata = memoryview(chan_data)[4+1::2] # 8-bit only ... zero-copy view skipping byte that is always 0 within each sample
+            elif ch in channels:
+                rawdata = channels[ch]
+            else:
+                continue
+            frame_channels[ch] = rawdata.tobytes() # receive buffers are reused by the next read
+        self.last_frame = Frame(None, self.last_header, self.header_id, header_changed, frame_channels, t_start, time.time(), self.decoded_header)
+        return self.last_frame
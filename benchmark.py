@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import asyncio
+import json
+import time
+import statistics
+
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_osci import FakeOsci
+from owonPDS6062T import OwonPDS6062T
+from relay_srv import DeviceRelay, ClientSendQueue, AcquisitionWorker, WS_TYPES, ACQ_MODES, SEND_POLICIES
+
+DEFAULT_DURATION=2.0
+# duration stages of OwonPDS6062T.last_timing
+TIMING_STAGES=('flush', 'write', 'first_byte', 'full_read')
+
+class Stats:
+    '''
+    latencies (in seconds) of repeated runs of a single stage
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        self.durations = []
+        self.elapsed = 0.0
+
+    def summary(self, unit: str = 'ops') -> dict:
+        d = sorted(self.durations)
+        if not d:
+            return {'name': self.name, 'count': 0}
+        return {
+            'name': self.name,
+            'count': len(d),
+            f'{unit}/s': len(d)/self.elapsed if self.elapsed else 0,
+            'mean_ms': statistics.fmean(d)*1000,
+            'p50_ms': d[len(d)//2]*1000,
+            'p95_ms': d[min(len(d)-1, int(len(d)*0.95))]*1000,
+            'max_ms': d[-1]*1000,
+        }
+
+def bench_call(name: str, fn: Callable, duration: float, unit: str = 'queries', osci: OwonPDS6062T = None) -> dict:
+    '''
+    osci - when set, mean per-stage breakdown and bytes read of its _send() calls (cf. OwonPDS6062T.last_timing) are reported as well
+    '''
+    stats = Stats(name)
+    breakdown = {}
+    bytes_read = 0
+    def on_timing(cmd, timing):
+        nonlocal bytes_read
+        for k in TIMING_STAGES:
+            breakdown[k] = breakdown.get(k, 0.0) + timing[k]
+        bytes_read += timing['bytes']
+    if osci:
+        osci.on_timing = on_timing
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        t0 = time.perf_counter()
+        fn()
+        stats.durations.append(time.perf_counter() - t0)
+    stats.elapsed = time.perf_counter() - start
+    res = stats.summary(unit)
+    if osci:
+        osci.on_timing = None
+        res.update({f'{k}_ms': v/len(stats.durations)*1000 for k, v in breakdown.items()})
+        res['MB/s'] = bytes_read/stats.elapsed/1e6
+    return res
+
+class FakeWsClient:
+    '''
+    stands in for OsciUpdatesWebsocket instance, records arrival of messages
+    '''
+    def __init__(self, device: DeviceRelay, last_msg_type: int, stats: Stats, send_delay: float = 0.0, send_policy: SEND_POLICIES = SEND_POLICIES.DROP_OLDEST):
+        self.device = device
+        self.last_msg_type = last_msg_type
+        self.stats = stats
+        self.send_delay = send_delay
+        self.last_frame_ts = None
+        self.bytes_received = 0
+        self.send_queue = ClientSendQueue(self.write_message, policy=send_policy)
+        self.send_queue.start()
+
+    async def write_message(self, message, binary=True):
+        if self.send_delay:
+            # emulates slow link to the client
+            await asyncio.sleep(self.send_delay)
+        self.bytes_received += len(message)
+        if message[0] != self.last_msg_type:
+            return
+        now = time.perf_counter()
+        if self.last_frame_ts is not None:
+            self.stats.durations.append(now - self.last_frame_ts)
+        self.last_frame_ts = now
+
+    def close(self):
+        self.send_queue.stop()
+        self.device.clients.discard(self)
+
+async def bench_broadcast(fake: FakeOsci, duration: float, clients_count: int = 1, acq_mode: ACQ_MODES = ACQ_MODES.SCREEN, slow_client_delay: float = 0.0, send_policy: SEND_POLICIES = SEND_POLICIES.DROP_OLDEST) -> dict:
+    '''
+    frames/s and latencies are measured on the first client; when slow_client_delay is set, one more client
+    delaying each message by slow_client_delay seconds is connected
+    '''
+    # polled as fast as possible to measure throughput of the relay itself
+    worker = AcquisitionWorker(usb_find=fake.find, acq_mode=acq_mode, max_poll_interval=0)
+    device = DeviceRelay('bench', worker, send_policy=send_policy)
+    last_msg_type = WS_TYPES.FRAME.value
+
+    stats = Stats(f'broadcast_screen_updates {acq_mode.value}' + (f' +slow client ({send_policy.value})' if slow_client_delay else ''))
+    clients = [FakeWsClient(device, last_msg_type, stats if i == 0 else Stats(''), send_policy=send_policy) for i in range(clients_count)]
+    if slow_client_delay:
+        clients.append(FakeWsClient(device, last_msg_type, Stats(''), slow_client_delay, send_policy))
+    device.clients = set(clients)
+    worker.start()
+
+    start = time.perf_counter()
+    await device.broadcast_screen_updates(lambda: time.perf_counter() - start >= duration)
+    stats.elapsed = time.perf_counter() - start
+    device.clients = set()
+    worker.stop()
+    worker.join()
+
+    res = stats.summary('frames')
+    res['clients'] = clients_count
+    res['MB/s per client'] = clients[0].bytes_received/stats.elapsed/1e6
+    if slow_client_delay:
+        res.update({f'slow_{k}': v for k, v in clients[-1].send_queue.stats().items()})
+    return res
+
+def run_benchmarks(latency: float, bytes_per_s: float, duration: float, clients_count: int) -> list:
+    fake = FakeOsci(latency=latency, bytes_per_s=bytes_per_s)
+    o = OwonPDS6062T(usb_find=fake.find)
+    results = [
+        bench_call('_send *IDN?', lambda: o._send('*IDN?'), duration, osci=o),
+        bench_call('_send HEAD?', lambda: o._send(':DATA:WAVE:SCREen:HEAD?'), duration, osci=o),
+        bench_call('_send CH1?', lambda: o._send(':DATA:WAVE:SCREen:CH1?'), duration, osci=o),
+        bench_call('get_header', o.get_header, duration),
+        bench_call('get_data(1)', lambda: list(o.get_data(1)), duration, 'frames'),
+        bench_call('get_depmem_all', o.get_depmem_all, duration, 'frames'),
+        asyncio.run(bench_broadcast(fake, duration, clients_count)),
+        asyncio.run(bench_broadcast(fake, duration, clients_count, ACQ_MODES.DEPMEM)),
+        asyncio.run(bench_broadcast(fake, duration, clients_count, ACQ_MODES.DEPMEM, 0.05, SEND_POLICIES.DROP_OLDEST)),
+        asyncio.run(bench_broadcast(fake, duration, clients_count, ACQ_MODES.DEPMEM, 0.05, SEND_POLICIES.BLOCK)),
+    ]
+    return results
+
+def print_results(results: list):
+    for r in results:
+        print(f"{r['name']:28} " + ' '.join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in r.items() if k != 'name'))
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark driver and relay throughput against emulated oscilloscope (no device needed).")
+    parser.add_argument(
+        "-l",
+        "--latency",
+        help="Emulated latency of each USB read in seconds.",
+        type=float,
+        nargs='?',
+        default=0.0005,
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        help="Emulated Bulk IN transfer rate in bytes/s (0 for unlimited).",
+        type=float,
+        nargs='?',
+        default=8e6,
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        help="Duration of each benchmark in seconds.",
+        type=float,
+        nargs='?',
+        default=DEFAULT_DURATION,
+    )
+    parser.add_argument(
+        "-c",
+        "--clients",
+        help="Number of emulated websocket clients of the relay.",
+        type=int,
+        nargs='?',
+        default=1,
+    )
+    parser.add_argument(
+        "-j",
+        "--json",
+        help="Store results to given JSON file (e.g. to compare runs for regressions).",
+        type=str,
+        nargs='?',
+        default=None,
+    )
+    return parser
+
+if __name__ == "__main__":
+    parser = build_parser()
+    pargs = parser.parse_args(sys.argv[1:])
+
+    results = run_benchmarks(pargs.latency, pargs.rate if pargs.rate else None, pargs.duration, pargs.clients)
+    print_results(results)
+    if pargs.json:
+        with open(pargs.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+'''
+streaming export of dumps (capture, dir of .dat files or their zip/tar archive) to chunked NumPy files
+
+Example of usage:
+    from dump_export import load_export
+    data = load_export('export')
+    data['t_start'], data['ch1_volts'], data['header']['ch1_scale']
+'''
+import os
+import sys
+import argparse
+import json
+import time
+import shutil
+from enum import Enum
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from live_dump import find_source, open_reader
+from measurements import screen_to_volts
+from units import scale_to_float, time_scale_to_float
+
+DEFAULT_CHUNK_FRAMES=1000
+MANIFEST_FILE='manifest.json'
+PROGRESS_INTERVAL=1.0 # s
+CHANNELS=(1, 2)
+
+# per-frame settings of the oscilloscope; unknown values are NaN, -1 or empty
+HEADER_DTYPE=np.dtype([
+    ('timebase', '<f8'), # s/div
+    ('hoffset', '<i4'),
+    ('sample_rate', 'U16'),
+    ('depmem', 'U8'),
+    ('trig_mode', 'U8'),
+    ('trig_type', 'U8'),
+    ('trig_channel', 'U4'),
+    ('trig_level', '<f8'), # V
+    ('trig_edge', 'U8'),
+    ('trig_sweep', 'U8'),
+]+[field for ch in CHANNELS for field in [
+    (f'ch{ch}_display', '?'),
+    (f'ch{ch}_scale', '<f8'), # V/div
+    (f'ch{ch}_offset', '<i4'),
+    (f'ch{ch}_probe', 'U8'),
+    (f'ch{ch}_coupling', 'U4'),
+    (f'ch{ch}_frequency', '<f8'), # Hz
+]])
+
+class EXPORT_FORMATS(Enum):
+    NPZ = 'npz' # single chunk_<no>.npz per chunk
+    NPY = 'npy' # dir chunk_<no>/ of <column>.npy files per chunk (can be loaded memory-mapped)
+
+def _parse(fn, value, default):
+    try:
+        return fn(value)
+    except Exception:
+        return default
+
+def header_row(head: dict) -> np.ndarray:
+    '''
+    HEAD json -> single element of HEADER_DTYPE
+    '''
+    row = np.zeros((), dtype=HEADER_DTYPE)
+    timebase = head.get('TIMEBASE', {})
+    sample = head.get('SAMPLE', {})
+    trig = head.get('Trig', {})
+    items = trig.get('Items', {})
+    row['timebase'] = _parse(time_scale_to_float, timebase.get('SCALE'), np.nan)
+    row['hoffset'] = _parse(int, timebase.get('HOFFSET'), -1)
+    row['sample_rate'] = str(sample.get('SAMPLERATE', '')).strip('()')
+    row['depmem'] = str(sample.get('DEPMEM', ''))
+    row['trig_mode'] = str(trig.get('Mode', ''))
+    row['trig_type'] = str(trig.get('Type', ''))
+    row['trig_channel'] = str(items.get('Channel', ''))
+    row['trig_level'] = _parse(scale_to_float, items.get('Level'), np.nan)
+    row['trig_edge'] = str(items.get('Edge', ''))
+    row['trig_sweep'] = str(trig.get('Sweep', ''))
+    for chan in head.get('CHANNEL', []):
+        ch = _parse(lambda n: int(n[-1]), chan.get('NAME'), None)
+        if ch not in CHANNELS:
+            continue
+        row[f'ch{ch}_display'] = chan.get('DISPLAY') == 'ON'
+        row[f'ch{ch}_scale'] = _parse(scale_to_float, chan.get('SCALE'), np.nan)
+        row[f'ch{ch}_offset'] = _parse(int, chan.get('OFFSET'), 0)
+        row[f'ch{ch}_probe'] = str(chan.get('PROBE', ''))
+        row[f'ch{ch}_coupling'] = str(chan.get('Coupling', ''))
+        row[f'ch{ch}_frequency'] = _parse(float, chan.get('FREQUENCE'), np.nan)
+    return row
+
+class ChunkBuffer:
+    '''
+    columns of up to `size` frames preallocated once; flushed whenever full or the number of points changes
+    '''
+    def __init__(self, size: int):
+        self.size = size
+        self.points = None
+        self.count = 0
+        self.first = None # index of the first frame within the source
+        self.columns = None
+
+    def _allocate(self, points: int):
+        self.points = points
+        self.columns = {
+            'frame': np.empty(self.size, dtype='<i8'),
+            'seq': np.empty(self.size, dtype='<i8'),
+            't_start': np.empty(self.size, dtype='<f8'),
+            't_end': np.empty(self.size, dtype='<f8'),
+            'header_id': np.empty(self.size, dtype='<i8'),
+            'header': np.empty(self.size, dtype=HEADER_DTYPE),
+        }
+        for ch in CHANNELS:
+            self.columns[f'ch{ch}_present'] = np.empty(self.size, dtype='?')
+            self.columns[f'ch{ch}_raw'] = np.empty((self.size, points), dtype='i1')
+            self.columns[f'ch{ch}_volts'] = np.empty((self.size, points), dtype='<f4')
+
+    def fits(self, points: int) -> bool:
+        return self.count < self.size and (self.count == 0 or points == self.points)
+
+    def append(self, i: int, frame: dict, header: np.ndarray, head: dict, points: int):
+        if self.columns is None or points != self.points:
+            self._allocate(points)
+        if self.count == 0:
+            self.first = i
+        n = self.count
+        c = self.columns
+        c['frame'][n] = i
+        c['seq'][n] = frame['seq'] if frame['seq'] is not None else -1
+        c['t_start'][n] = frame['t_start'] if frame['t_start'] is not None else np.nan
+        c['t_end'][n] = frame['t_end'] if frame['t_end'] is not None else np.nan
+        c['header_id'][n] = frame['header_id'] if frame['header_id'] is not None else -1
+        c['header'][n] = header
+        for ch in CHANNELS:
+            samples = frame['channels'].get(ch)
+            present = samples is not None and len(samples) == points
+            c[f'ch{ch}_present'][n] = present
+            if not present:
+                c[f'ch{ch}_raw'][n] = 0
+                c[f'ch{ch}_volts'][n] = np.nan
+                continue
+            c[f'ch{ch}_raw'][n] = samples
+            chan = next((x for x in head.get('CHANNEL', []) if x.get('NAME') == f'CH{ch}'), None) if head else None
+            c[f'ch{ch}_volts'][n] = screen_to_volts(samples, chan) if chan else np.nan
+        self.count += 1
+
+    def write(self, path: str, fmt: EXPORT_FORMATS):
+        '''
+        chunk appears under its final name only once complete (an interrupted export leaves no partial chunk)
+        '''
+        columns = {k: v[:self.count] for k, v in self.columns.items()}
+        tmp = path + '.tmp'
+        if fmt == EXPORT_FORMATS.NPZ:
+            with open(tmp, 'wb') as f:
+                np.savez(f, **columns)
+            os.replace(tmp, path + '.npz')
+        else:
+            os.makedirs(tmp, exist_ok=True)
+            for k, v in columns.items():
+                np.save(os.path.join(tmp, k + '.npy'), v)
+            if os.path.isdir(path):
+                # written by the interrupted export but not recorded in the manifest
+                shutil.rmtree(path)
+            os.replace(tmp, path)
+        self.count = 0
+
+def read_manifest(out_dir: str) -> dict:
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(out_dir: str, manifest: dict):
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def source_path(source: tuple) -> str:
+    kind, arg = source
+    return os.path.abspath(arg if isinstance(arg, str) else os.path.commonpath(arg)) if arg else ''
+
+def export(source: tuple, out_dir: str, chunk_frames: int = DEFAULT_CHUNK_FRAMES, fmt: EXPORT_FORMATS = EXPORT_FORMATS.NPZ, force: bool = False):
+    '''
+    source - as returned by live_dump.find_source()
+
+    memory is bounded by single chunk; an interrupted export is resumed from the last complete chunk (unless force is set)
+    '''
+    reader = open_reader(source)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = read_manifest(out_dir)
+    if manifest and force:
+        for chunk in manifest['chunks']:
+            path = os.path.join(out_dir, chunk['name'])
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        manifest = None
+    if manifest and (manifest['source'] != source_path(source) or manifest['format'] != fmt.value or manifest['chunk_frames'] != chunk_frames):
+        raise Exception(f"{out_dir} holds export of {manifest['source']} ({manifest['format']}, {manifest['chunk_frames']} frames per chunk); use --force to overwrite")
+    if not manifest:
+        manifest = {
+            'source': source_path(source),
+            'format': fmt.value,
+            'chunk_frames': chunk_frames,
+            'next': 0, # index of the first frame not exported yet
+            'chunks': [],
+        }
+    start = manifest['next']
+    total = len(reader)
+    print(f"exporting {total-start} frames" + (f" (resuming after {start})" if start else ""))
+
+    buf = ChunkBuffer(chunk_frames)
+    last_header = None
+    header = head = None
+    started = last_report = time.monotonic()
+
+    def flush(next_: int):
+        name = f'chunk_{len(manifest["chunks"]):06d}'
+        buf.write(os.path.join(out_dir, name), fmt)
+        manifest['chunks'].append({'name': name + ('.npz' if fmt == EXPORT_FORMATS.NPZ else ''), 'first': buf.first, 'count': next_-buf.first, 'points': buf.points})
+        manifest['next'] = next_
+        write_manifest(out_dir, manifest)
+
+    for i in range(start, total):
+        frame = reader.frame(i)
+        if frame['head'] is not None and frame['head'] != last_header:
+            # header rarely changes ... parsed only when it does
+            last_header = bytes(frame['head'])
+            head = json.loads(last_header.decode('utf-8').strip())
+            header = header_row(head)
+        points = max((len(s) for s in frame['channels'].values()), default=0)
+        if not buf.fits(points):
+            flush(i)
+        buf.append(i, frame, header if header is not None else np.zeros((), dtype=HEADER_DTYPE), head, points)
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            print(f"exported {i+1-start}/{total-start} frames, {(i+1-start)/(now-started):.0f} frames/s")
+    if buf.count:
+        flush(total)
+    reader.close()
+    print(f"exported {total-start} frames to {len(manifest['chunks'])} chunks in {out_dir}")
+
+def load_export(out_dir: str, columns: list = None, mmap_mode: str = None) -> dict:
+    '''
+    all chunks concatenated: {column: array}; chunks of different number of points cannot be concatenated, cf. load_chunks()
+    '''
+    chunks = list(load_chunks(out_dir, columns, mmap_mode))
+    return {k: np.concatenate([c[k] for c in chunks]) for k in (chunks[0] if chunks else [])}
+
+def load_chunks(out_dir: str, columns: list = None, mmap_mode: str = None):
+    '''
+    yields {column: array} per chunk; mmap_mode (e.g. 'r') applies to chunks in .npy format
+    '''
+    manifest = read_manifest(out_dir)
+    if not manifest:
+        raise Exception(f"no export found in {out_dir}")
+    for chunk in manifest['chunks']:
+        path = os.path.join(out_dir, chunk['name'])
+        if manifest['format'] == EXPORT_FORMATS.NPZ.value:
+            with np.load(path) as data:
+                yield {k: data[k] for k in (columns or data.files)}
+        else:
+            names = columns or [f[:-4] for f in sorted(os.listdir(path)) if f.endswith('.npy')]
+            yield {k: np.load(os.path.join(path, k + '.npy'), mmap_mode=mmap_mode) for k in names}
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Export dumps (capture, dir of .dat files or their zip/tar archive) to chunked NumPy files: per-channel int8 samples and float32 volts, timestamps and header fields.")
+    parser.add_argument(
+        "source",
+        help="Capture dir, dir of .dat files or archive of them.",
+        type=str,
+    )
+    parser.add_argument(
+        "-o",
+        "--out_dir",
+        help="Output directory; an interrupted export into it is resumed.",
+        type=str,
+        nargs="?",
+        default="export",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk-frames",
+        help="Number of frames per chunk (bounds memory used by the export).",
+        type=int,
+        nargs="?",
+        default=DEFAULT_CHUNK_FRAMES,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        help="'npz' writes single file per chunk, 'npy' dir of .npy files per chunk (allows to load them memory-mapped).",
+        choices=[f.value for f in EXPORT_FORMATS],
+        nargs="?",
+        default=EXPORT_FORMATS.NPZ.value,
+    )
+    parser.add_argument(
+        "--force",
+        help="Start the export anew instead of resuming it.",
+        action="store_true"
+    )
+    return parser
+
+if __name__ == "__main__":
+    parser = build_parser()
+    pargs = parser.parse_args(sys.argv[1:])
+    export(find_source(pargs.source), pargs.out_dir, pargs.chunk_frames, EXPORT_FORMATS(pargs.format), pargs.force)
@@ -3,17 +3,23 @@ import os
 import sys
 import argparse
 import json
+import time
+import multiprocessing
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from live_dump import DataProcessor
+from live_dump import find_source, open_reader
 import matplotlib.pyplot as plt
 from osc_plot import Plotter, to_screen
 
+CH1_COLOR = "#eed807"
+CH2_COLOR = "#67c7ff"
+PROGRESS_INTERVAL = 1.0 # s
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Relay updates from oscilloscope and commands to it over network. Allows to have multiple clients connected to single osci.")
     parser.add_argument(
         "file",
-        help="Dump file to be reconstructed as oscilloscope screen data. If dir is passed all the relevant data in the dir are converted to image.",
+        help="Dump file to be reconstructed as oscilloscope screen data. If dir is passed all the relevant data in the dir (.dat files or frames of capture) are converted to image.",
         type=str,
     )
     parser.add_argument(
@@ -27,82 +33,161 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "-v",
         "--view",
-        help="Display matplotlib instead of writing out corresponding jpg file. Arrow keys allow to navigate to neighboring files.",
+        help="Display matplotlib instead of writing out corresponding jpg file. Arrow keys allow to navigate to neighboring files (frames of capture): left/right by 1, down/up by 10, page down/up by 100.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of processes rendering the jpg files (0 for number of CPUs).",
+        type=int,
+        nargs="?",
+        default=1,
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        help="Render also frames whose jpg file already exists.",
         action="store_true"
     )
     return parser
 
+def target_path(name: str, out_dir: str = None) -> str:
+    target_file = name[:-3]+'jpg'
+    if out_dir:
+        target_file = out_dir + '/' + target_file.split('/')[-1]
+    return target_file
+
+class FrameRenderer:
+    '''
+    single figure reused for all the frames: only curves and title are updated per frame, grid and axes stay
+    '''
+    def __init__(self, reader):
+        self.reader = reader
+        self.plotter = Plotter()
+        self.fig, self.ax = self.plotter.init_plot([CH1_COLOR, CH2_COLOR])
+        ln1, = plt.plot([], [], color=CH1_COLOR)
+        ln2, = plt.plot([], [], color=CH2_COLOR)
+        self.lines = [ln1, ln2]
+        self.x_data_pts_range = self.plotter.get_x_pts_range()
+        self.last_head = None
+
+    def plot_frame(self, i: int) -> bool:
+        '''
+        returns False (curves are cleared) for frame received before any header
+        '''
+        frame = self.reader.frame(i)
+
+        self.ax.set_title(self.reader.names[i][:-4] + ('' if frame['head'] is not None else ' (no header)'), y=1.04)
+        if frame['head'] is None:
+            for line in self.lines:
+                line.set_data([], [])
+            return False
+
+        if frame['head'] != self.last_head:
+            # header rarely changes ... its annotations are redrawn only when needed
+            self.last_head = bytes(frame['head'])
+            self.plotter.apply_head(json.loads(self.last_head))
+
+        for ch, line in enumerate(self.lines, 1):
+            samples = frame['channels'].get(ch)
+            line.set_data(self.x_data_pts_range, to_screen(samples, 8)) if samples is not None else line.set_data([], [])
+        return True
+
+    def save(self, i: int, target_file: str) -> bool:
+        if not self.plot_frame(i):
+            return False
+        self.fig.savefig(target_file)
+        return True
+
+_worker_renderer = None
+def _init_worker(source: tuple):
+    global _worker_renderer
+    plt.switch_backend('Agg')
+    _worker_renderer = FrameRenderer(open_reader(source))
+
+def _render_chunk(chunk: list) -> tuple:
+    '''
+    returns number of frames processed and of those without header
+    '''
+    headless = sum(not _worker_renderer.save(i, target_file) for i, target_file in chunk)
+    return len(chunk), headless
+
+def render_all(source: tuple, out_dir: str = None, jobs: int = 1, force: bool = False):
+    '''
+    renders jpg file of each frame of source; frames rendered already (jpg newer than the source) are skipped unless force is set,
+    frames without header are skipped always
+    '''
+    reader = open_reader(source)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    todo = [(i, target_path(name, out_dir)) for i, name in enumerate(reader.names)]
+    skipped = len(todo)
+    if not force:
+        todo = [(i, f) for i, f in todo if not os.path.exists(f) or os.path.getmtime(f) < reader.mtime(i)]
+    skipped -= len(todo)
+    print(f"rendering {len(todo)} frames" + (f" ({skipped} rendered already)" if skipped else "") + (f" by {jobs} processes" if jobs > 1 else ""))
+
+    started = last_report = time.monotonic()
+    done = headless = 0
+    def report(final: bool = False):
+        nonlocal last_report
+        now = time.monotonic()
+        if final or now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            rate = done/(now-started) if now > started else 0
+            print(f"rendered {done}/{len(todo)} frames, {rate:.1f} frames/s" + (f", {(len(todo)-done)/rate:.0f} s left" if rate and not final else ""))
+
+    if jobs > 1:
+        # contiguous chunks keep header changes (redraw of annotations) rare within each worker
+        chunk_size = max(1, min(50, len(todo)//(jobs*4)))
+        chunks = [todo[i:i+chunk_size] for i in range(0, len(todo), chunk_size)]
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(source,)) as pool:
+            for count, chunk_headless in pool.imap_unordered(_render_chunk, chunks):
+                done += count
+                headless += chunk_headless
+                report()
+    else:
+        plt.switch_backend('Agg')
+        renderer = FrameRenderer(reader)
+        for i, target_file in todo:
+            headless += not renderer.save(i, target_file)
+            done += 1
+            report()
+    report(final=True)
+    if headless:
+        print(f"skipped {headless} frames received before any header")
+
 if __name__ == "__main__":
     parser = build_parser()
     pargs = parser.parse_args(sys.argv[1:])
 
-    proc = DataProcessor()
-    files_to_process = []
-    if os.path.isdir(pargs.file):
-        for root, dir_, files in os.walk(pargs.file):
-            files_to_process.extend(map(lambda f: root+f, filter(lambda f: f.endswith('.dat'), files)))
+    source = find_source(pargs.file, neighbors=pargs.view)
+    if pargs.view:
+        renderer = FrameRenderer(open_reader(source))
+        reader = renderer.reader
+        current = 0
+        if source[0] == 'dat' and not os.path.isdir(pargs.file):
+            print("loading all neighboring files: use left <- and right -> arrow keys to navigate")
+            # names are joined with the dir ... compared as absolute paths
+            paths = [os.path.abspath(name) for name in reader.names]
+            if os.path.abspath(pargs.file) not in paths:
+                raise Exception(f"'{pargs.file}' not found among the dumps of its dir")
+            current = paths.index(os.path.abspath(pargs.file))
+        def nav(event):
+            global current
+            steps = {'right': 1, 'left': -1, 'up': 10, 'down': -10, 'pageup': 100, 'pagedown': -100}
+            if event.key not in steps:
+                return
+            current = (current + steps[event.key])%len(reader)
+            renderer.plot_frame(current)
+            renderer.fig.canvas.draw_idle()
+        renderer.fig.canvas.mpl_connect('key_press_event', nav)
+        renderer.plot_frame(current)
+        plt.show()
     else:
-        files_to_process.append(pargs.file)
-
-    # init plot
-    plotter = Plotter()
-    ch1_color = "#eed807"
-    ch2_color = "#67c7ff"
-    fig_ax = plotter.init_plot([ch1_color, ch2_color])
-    fig, ax = fig_ax
-
-    ln1, = plt.plot([], [], color=ch1_color)
-    ln2, = plt.plot([], [], color=ch2_color)
-    lines = [ln1, ln2]
-
-    def plot_file(f: str):
-        with open(f, 'rb') as dat_file:
-            data=dat_file.read()
-        proc.load_dump_obj(data)
-
-        ax.set_title(f[:-4], y=1.04)
-
-        head_json = json.loads(proc.head[5:])
-        ch1_data = to_screen(DataProcessor.samples_to_ints(proc.ch1_data[5:]), 8)
-        ch2_data = to_screen(DataProcessor.samples_to_ints(proc.ch2_data[5:]), 8)
-
-        plotter.apply_head(head_json)
-
-        x_data_pts_range = plotter.get_x_pts_range()
-        if ch1_data:
-            lines[0].set_data(x_data_pts_range, ch1_data) if ch1_data else None
-        if ch2_data:
-            lines[1].set_data(x_data_pts_range, ch2_data) if ch2_data else None
-
-    for f in files_to_process:
-        plot_file(f)
-
-        if pargs.view:
-            all_files = files_to_process
-            next_f = f
-            def nav(event):
-                global next_f
-                if event.key == 'right':
-                    next_f = all_files[(all_files.index(next_f) + 1)%len(all_files)]
-                elif event.key == 'left':
-                    next_f = all_files[(all_files.index(next_f) - 1)%len(all_files)]
-                else:
-                    return
-                plot_file(next_f)
-                plt.show()
-            fig.canvas.mpl_connect('key_press_event', nav)
-            if not os.path.isdir(pargs.file):
-                print("loading all neighboring files: use left <- and right -> arrow keys to navigate")
-                f_dir = os.path.dirname(f)
-                all_files = sorted(map(lambda p: f_dir+'/'+p, os.listdir(f_dir)))
-            plt.show()
-        else:
-            target_file = f[:-3]+'jpg'
-            if pargs.out_dir:
-                try:
-                    os.mkdir(pargs.out_dir)
-                except Exception:
-                    pass
-                target_file = pargs.out_dir + '/' + target_file.split('/')[-1]
-            print(f"Storing to {target_file}")
-            plt.savefig(target_file)
+        out_dir = pargs.out_dir
+        if out_dir is None and source[0] == 'archive':
+            # members of the archive are rendered next to it
+            out_dir = os.path.dirname(pargs.file) or '.'
+        render_all(source, out_dir, pargs.jobs if pargs.jobs > 0 else os.cpu_count(), pargs.force)
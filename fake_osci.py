@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+in-process stand-in for the Owon PDS6062T speaking its USB protocol
+
+Example of usage with OwonPDS6062T:
+    from owonPDS6062T import OwonPDS6062T
+    from fake_osci import FakeOsci
+    fake = FakeOsci(latency=0.001, bytes_per_s=8_000_000)
+    o = OwonPDS6062T(usb_find=fake.find)
+    print(o.get_header())
+'''
+import time
+import json
+import math
+import array
+import threading
+
+import usb.core
+
+VENDOR_ID = 0x5345
+PRODUCT_ID = 0x1234
+EP_OUT = 0x3
+EP_IN = 0x81
+
+SCREEN_POINTS = 1520
+
+def default_header():
+    return {
+        'TIMEBASE': {'SCALE': '200us', 'HOFFSET': 0},
+        'SAMPLE': {'FULLSCREEN': SCREEN_POINTS, 'SLOWMOVE': -1, 'DATALEN': SCREEN_POINTS, 'SAMPLERATE': '(500MS/s)', 'TYPE': 'SAMPle', 'DEPMEM': '10K'},
+        'CHANNEL': [
+            {'NAME': 'CH1', 'DISPLAY': 'ON', 'Coupling': 'DC', 'PROBE': '10X', 'SCALE': '1.00V', 'OFFSET': 0, 'FREQUENCE': 1000.0},
+            {'NAME': 'CH2', 'DISPLAY': 'ON', 'Coupling': 'DC', 'PROBE': '10X', 'SCALE': '500mV', 'OFFSET': -50, 'FREQUENCE': 2000.0},
+        ],
+        'Trig': {'Mode': 'SINGle', 'Type': 'EDGE', 'Items': {'Channel': 'CH1', 'Level': '0.00mV', 'Edge': 'RISE', 'Coupling': 'DC'}, 'Sweep': 'AUTO'},
+    }
+
+class FakeOsci:
+    '''
+    emulates the pyusb device returned by usb.core.find() for the oscilloscope
+
+    latency - seconds spent before each read returns its first byte
+    bytes_per_s - transfer rate of the Bulk IN endpoint (None for unlimited)
+    frames_count - number of distinct precomputed captures cycled through per channel
+    '''
+    def __init__(self, latency: float = 0.0, bytes_per_s: float = None, frames_count: int = 16, header: dict = None, serial_number: str = '0000000', bus: int = 1, address: int = 1):
+        self.latency = latency
+        self.bytes_per_s = bytes_per_s
+        self.idVendor = VENDOR_ID
+        self.idProduct = PRODUCT_ID
+        self.serial_number = serial_number
+        self.bus = bus
+        self.address = address
+        self.header = header if header else default_header()
+        self.writes_count = 0
+        self.reads_count = 0
+        self._pending = bytearray()
+        self._lock = threading.Lock()
+        self._frame_idx = {1: 0, 2: 0}
+        self._frames = {ch: [self._make_frame(ch, i, frames_count) for i in range(frames_count)] for ch in range(1, 3)}
+
+    def find(self, find_all=False, **kwargs):
+        '''
+        drop-in replacement for usb.core.find
+        '''
+        return FakeUsbBus([self]).find(find_all, **kwargs)
+
+    def set_configuration(self):
+        pass
+
+    @staticmethod
+    def _make_frame(ch: int, idx: int, frames_count: int) -> bytes:
+        '''
+        2 bytes per sample, first byte is always 0, second is the signed 8-bit screen value
+        '''
+        phase = 2*math.pi*idx/frames_count
+        periods = 3*ch
+        amplitude = 90 if ch == 1 else 60
+        samples = bytearray(2*SCREEN_POINTS)
+        for i in range(SCREEN_POINTS):
+            v = int(amplitude*math.sin(2*math.pi*periods*i/SCREEN_POINTS + phase))
+            samples[2*i+1] = v & 0xff
+        return bytes(samples)
+
+    def _next_frame(self, ch: int) -> bytes:
+        frames = self._frames[ch]
+        frame = frames[self._frame_idx[ch]]
+        self._frame_idx[ch] = (self._frame_idx[ch] + 1) % len(frames)
+        return frame
+
+    @staticmethod
+    def _with_length(body: bytes) -> bytes:
+        return len(body).to_bytes(4, 'little') + body
+
+    def _respond(self, cmd: str) -> bytes:
+        if cmd == '*IDN?':
+            return b'OWON,PDS6062T,0000000,V0.0.0-fake'
+        if cmd == ':DATA:WAVE:SCREen:HEAD?':
+            return self._with_length(json.dumps(self.header).encode('utf-8'))
+        if cmd.startswith(':DATA:WAVE:SCREen:CH'):
+            ch = int(cmd[len(':DATA:WAVE:SCREen:CH')])
+            return self._with_length(self._next_frame(ch))
+        if cmd == ':DATA:WAVE:DEPMem:All?':
+            body = self._with_length(json.dumps(self.header).encode('utf-8'))
+            for ch_desc in self.header['CHANNEL']:
+                ch = int(ch_desc['NAME'][-1])
+                body += self._with_length(self._next_frame(ch) if ch_desc['DISPLAY'] == 'ON' else b'')
+            return self._with_length(body)
+        if cmd == ':DATA:WAVE:SCREen:BMP?':
+            return self._with_length(bytes(800*480*2))
+        if cmd.startswith(':MEASUrement:CH') or cmd == ':MEASUrement:ALL?':
+            return self._with_length(b'{"MAX":"1.00V","MIN":"-1.00V","PKPK":"2.00V"}')
+        return b'0'
+
+    def _apply(self, cmd: str):
+        parts = cmd.split()
+        if len(parts) == 2 and parts[0].upper().startswith(':CH') and parts[0].upper().endswith(':DISP'):
+            self.header['CHANNEL'][int(parts[0][3])-1]['DISPLAY'] = parts[1].upper()
+        elif len(parts) == 2 and parts[0].upper() == ':HORIZONTAL:SCALE':
+            self.header['TIMEBASE']['SCALE'] = parts[1]
+
+    def write(self, endpoint, data, timeout=None):
+        if endpoint != EP_OUT:
+            raise usb.core.USBError(f'invalid endpoint {endpoint}')
+        cmd = data.decode('utf-8') if isinstance(data, (bytes, bytearray)) else str(data)
+        with self._lock:
+            self.writes_count += 1
+            if cmd.endswith('?'):
+                self._pending.extend(self._respond(cmd))
+            else:
+                self._apply(cmd)
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        if endpoint != EP_IN:
+            raise usb.core.USBError(f'invalid endpoint {endpoint}')
+        size = size_or_buffer if isinstance(size_or_buffer, int) else len(size_or_buffer)
+        with self._lock:
+            self.reads_count += 1
+            chunk = bytes(self._pending[:size])
+            del self._pending[:size]
+        if not chunk:
+            # nothing queued: the real device keeps the transfer pending until timeout
+            time.sleep((timeout or 0)/1000)
+            raise usb.core.USBTimeoutError('Operation timed out', errno=110)
+        delay = self.latency + (len(chunk)/self.bytes_per_s if self.bytes_per_s else 0)
+        if delay:
+            time.sleep(delay)
+        if isinstance(size_or_buffer, int):
+            return array.array('B', chunk)
+        memoryview(size_or_buffer)[:len(chunk)] = chunk
+        return len(chunk)
+
+class FakeUsbBus:
+    '''
+    several emulated oscilloscopes connected at once
+
+    Example of usage:
+        bus = FakeUsbBus([FakeOsci(serial_number='A', address=1), FakeOsci(serial_number='B', address=2)])
+        o = OwonPDS6062T(usb_find=bus.find, serial='B')
+    '''
+    def __init__(self, devices: list):
+        self.devices = devices
+
+    def find(self, find_all=False, **kwargs):
+        '''
+        drop-in replacement for usb.core.find: devices are matched by values of their attributes (e.g. idVendor, bus)
+        '''
+        found = [d for d in self.devices if all(getattr(d, k, None) == v for k, v in kwargs.items() if v is not None)]
+        if find_all:
+            return iter(found)
+        return found[0] if found else None
@@ -2,6 +2,7 @@
 import os
 import sys
 import argparse
+import base64
 
 import requests
 
@@ -10,21 +11,61 @@ from relay_srv import DEFAULT_PORT, WS_TYPES
 DEFAULT_HOST="localhost"
 
 class OsciCommander():
-    def __init__(self, host, port, silent = True):
+    def __init__(self, host, port, silent = True, device: str = None):
+        '''
+        device - id of the oscilloscope when the relay serves several (cf. '/devices' of relay_srv.py)
+        '''
         self.host = host
         self.port = port
         self.silent = silent
+        self.device = device
+        # keeps the connection to the relay alive between commands
+        self.session = requests.Session()
+
+    def _url(self, path: str) -> str:
+        return f'http://{self.host}:{self.port}/{path}' + (f'/{self.device}' if self.device else '')
 
     def query(self, query: str, silent = None):
-        r = requests.post(f'http://{self.host}:{self.port}/query', data=query)
+        r = self.session.post(self._url('query'), data=query)
         s = self.silent if silent is None else silent
         None if s else print(r.content)
         return r
 
     def write(self, cmd: str):
-        r = requests.post(f'http://{self.host}:{self.port}/write', data=cmd)
+        r = self.session.post(self._url('write'), data=cmd)
         return r
 
+    def batch(self, commands: list, silent = None) -> list:
+        '''
+        commands are executed in order within single request, no other client's command interleaves them
+
+        Returns
+        -------
+        [None for write, bytes response for query]
+        '''
+        r = self.session.post(self._url('batch'), json=commands)
+        try:
+            reply = r.json()
+        except ValueError:
+            # failure of the relay itself (e.g. USB error) is not answered by JSON
+            raise Exception(f'batch failed with HTTP {r.status_code}: {r.text}')
+        if r.status_code == 400:
+            raise Exception(reply['error'])
+        results = []
+        for cmd, res in zip(commands, reply):
+            if 'error' in res:
+                raise Exception(f"{cmd}: {res['error']}")
+            if 'response_base64' in res:
+                results.append(base64.b64decode(res['response_base64']))
+            else:
+                results.append(res['response'].encode('utf-8') if 'response' in res else None)
+        s = self.silent if silent is None else silent
+        None if s else print(results)
+        return results
+
+    def close(self):
+        self.session.close()
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Start interactive session allowing to command and query oscilloscope.")
     parser.add_argument(
@@ -43,13 +84,21 @@ def build_parser() -> argparse.ArgumentParser:
         nargs='?',
         default=DEFAULT_PORT,
     )
+    parser.add_argument(
+        "-D",
+        "--device",
+        help="Id of the oscilloscope when the relay serves several (listed by '/devices'); the first one by default.",
+        type=str,
+        nargs='?',
+        default=None,
+    )
     return parser
 
 if __name__ == "__main__":
     parser = build_parser()
     pargs = parser.parse_args(sys.argv[1:])
 
-    c = OsciCommander(pargs.host, pargs.port, False)
+    c = OsciCommander(pargs.host, pargs.port, False, pargs.device)
 
     import code, rlcompleter, readline
     history_file_path=os.path.expanduser('~/.python_history')
@@ -58,5 +107,6 @@ if __name__ == "__main__":
     readline.parse_and_bind("tab: complete")
     print(" - c.query('*IDN?')")
     print(" - c.write(':HORIzontal:SCALe 100ms')")
+    print(" - c.batch([':HORIzontal:SCALe 100ms', ':HORIzontal:SCALe?'])")
     print("")
     code.interact(local=locals())
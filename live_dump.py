@@ -4,66 +4,157 @@ import sys
 import argparse
 import signal
 import json
+import time
+import struct
+import mmap
+import tarfile
+import zipfile
+import copy
+import asyncio
+import collections
 from datetime import datetime
 
+from enum import Enum
 from typing import Callable
 
-from websocket import create_connection
+import numpy as np
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from units import scale_to_float
-from relay_srv import WS_TYPES, DEFAULT_PORT
+from measurements import screen_to_volts
+from relay_srv import WS_TYPES, WS_ENCODINGS, DEFAULT_PORT, FRAME_FIELDS, FRAME_FLAG_HEAD, encode_frame_msg, decode_frame_msg
+from relay_client import RelayClient, merge, parse_target
 DEFAULT_HOST="localhost"
 DEFAULT_DUMP_DIR="dump"
+DEFAULT_SEGMENT_SIZE=256 # MB
+DEFAULT_SEGMENT_TIME=3600 # s
+DAT_CACHE_SIZE=64 # frames kept mapped by DatReader
+
+class DUMP_FORMATS(Enum):
+    CAPTURE = 'capture' # segmented append-only frame log with index (cf. CaptureWriter)
+    DAT = 'dat' # single file per frame (cf. DataProcessor.make_dump_obj())
+
+CAPTURE_MAGIC=b'OWONCAP\x01'
+CAPTURE_SEGMENT_EXT='.cap'
+CAPTURE_INDEX_EXT='.idx'
+# number of the frame within the capture, seq, t_start, offset of the FRAME record, its length, offset of the FRAME record carrying the valid header
+# (seq is assigned by the relay and restarts along with it ... only the frame number is unique)
+CAPTURE_INDEX_ENTRY=struct.Struct('<QQdQIQ')
+CAPTURE_INDEX_DTYPE=np.dtype([('frame', '<u8'), ('seq', '<u8'), ('t_start', '<f8'), ('offset', '<u8'), ('length', '<u4'), ('header_offset', '<u8')])
 
 class LiveReceiver:
-    def __init__(self, host, port):
+    '''
+    blocking receiver of single relay (cf. relay_client.RelayClient for asyncio)
+    '''
+    def __init__(self, host, port, encoding: WS_ENCODINGS = WS_ENCODINGS.RAW):
+        '''
+        encoding - channels encoding negotiated with the relay; cb_on_data always gets raw messages
+        '''
         self.host = host
         self.port = port
+        self.encoding = encoding
 
     def start(self, cb_on_data: Callable[[object], None], should_continue: Callable = lambda: True):
-        target = f'ws://{self.host}:{self.port}/updates_ws'
-        print(f"connecting to oscilloscope relay on '{target}")
-        ws = create_connection(target)
-        while should_continue():
-            rawdata = ws.recv()
-            if not len(rawdata):
-                print('ws disconnected ... exiting')
-                break
-            cb_on_data(rawdata)
-        ws.close()
+        asyncio.run(self._receive(cb_on_data, should_continue))
+
+    async def _receive(self, cb_on_data: Callable[[object], None], should_continue: Callable):
+        async with RelayClient(self.host, self.port, self.encoding) as client:
+            while should_continue():
+                rawdata = await client.get(timeout=0.5)
+                if rawdata is not None:
+                    cb_on_data(rawdata)
 
 class DataProcessor():
     def __init__(self):
         self.head = None
         self.ch1_data = None
         self.ch2_data = None
+        # acquisition metadata of the last FRAME message (None when legacy messages are received)
+        self.seq = None
+        self.t_start = None
+        self.t_end = None
+        self.header_id = None
+        self.missed_frames = 0
+        self._decoded_head = (None, None) # (head, json) ... header is decoded once per its change
 
-    def store_live_data(self, new_data):
+    def store_live_data(self, new_data) -> bool:
+        '''
+        returns True when new_data completes a frame (frames received before any header are not complete)
+        '''
         if WS_TYPES(new_data[0]).name == 'HEAD':
             self.head = new_data
         elif WS_TYPES(new_data[0]).name == 'CH1_DATA':
             self.ch1_data = new_data
         elif WS_TYPES(new_data[0]).name == 'CH2_DATA':
             self.ch2_data = new_data
+            # presume each time CH2_DATA comes, all necessary data were received for the frame to be complete
+            return self.head is not None
+        elif WS_TYPES(new_data[0]).name == 'FRAME':
+            self.store_frame(new_data)
+            return self.head is not None
+        return False
+
+    def store_frame(self, new_data):
+        '''
+        unpack FRAME message into HEAD and CHx_DATA messages; channels missing in the frame are set to None
+        '''
+        frame = decode_frame_msg(new_data)
+        if self.seq is not None and frame['seq'] > self.seq+1:
+            self.missed_frames += frame['seq']-self.seq-1
+        self.seq = frame['seq']
+        self.t_start = frame['t_start']
+        self.t_end = frame['t_end']
+        self.header_id = frame['header_id']
+        if frame['header'] is not None:
+            self.head = bytes([WS_TYPES.HEAD.value])+frame['header']
+        for ch in range(1,3):
+            samples = frame['channels'].get(ch)
+            data = None if samples is None else bytes([WS_TYPES(ch).value])+len(samples).to_bytes(4, 'little')+samples
+            setattr(self, f'ch{ch}_data', data)
+
+    def make_frame_msg(self, with_header: bool = False, seq: int = 0, t_start: float = 0.0) -> bytes:
+        '''
+        FRAME message of the stored data; seq and t_start are used only when legacy messages were received
+        '''
+        channels = {ch: memoryview(data)[5:] for ch, data in ((1, self.ch1_data), (2, self.ch2_data)) if data}
+        if self.seq is not None:
+            seq, t_start = self.seq, self.t_start
+        t_end = self.t_end if self.t_end is not None else t_start
+        return encode_frame_msg(seq, t_start, t_end, self.header_id or 0, memoryview(self.head)[1:] if with_header else None, channels)
 
     def make_dump_obj(self, ):
-        return self.head+self.ch1_data+self.ch2_data
+        if self.seq is None:
+            return self.head+(self.ch1_data or b'')+(self.ch2_data or b'')
+        # header is kept as separate HEAD field so that every dump is self-contained
+        return self.head+self.make_frame_msg()
+
+    @staticmethod
+    def field_offsets(data) -> list:
+        '''
+        (type, offset, length) of each message of the dump object
+        '''
+        fields = []
+        offset = 0
+        while offset+5 <= len(data):
+            fld_len = int.from_bytes(data[offset+1:offset+5], 'little', signed=False)+1+4 # 1: type, 4: len
+            fields.append((data[offset], offset, fld_len))
+            offset += fld_len
+        return fields
 
     def load_dump_obj(self, data):
-        while data:
-            fld_len = int.from_bytes(data[1:5], 'little', signed=False)+1+4 # 1: type, 4: len
-            self.store_live_data(data[:fld_len])
-            data = data[fld_len:]
+        for _, offset, fld_len in DataProcessor.field_offsets(data):
+            self.store_live_data(data[offset:offset+fld_len])
 
     @staticmethod
-    def samples_to_ints(rawsamples: bytes, bytes_per_sample: int = 1, little_endian: bool = False):
-        return map(lambda x: int.from_bytes(x, 'little' if little_endian else 'big', signed=True), [rawsamples[i:i+bytes_per_sample] for i in range(0, len(rawsamples), bytes_per_sample)])
+    def samples_to_ints(rawsamples: bytes, bytes_per_sample: int = 1, little_endian: bool = False) -> np.ndarray:
+        '''
+        zero-copy view interpreting rawsamples as signed ints of bytes_per_sample size
+        '''
+        return np.frombuffer(rawsamples, dtype=np.dtype(f"{'<' if little_endian else '>'}i{bytes_per_sample}"))
 
     @staticmethod
     def map_screen_data_point_to_range(screen_point: int, target_range: int, point_bits: int = 8):
         '''
-        screen_point - python int (not the original byte encoded sample -- cf. samples_to_ints())
+        screen_point - python int or numpy array of ints (not the original byte encoded sample -- cf. samples_to_ints())
         point_bits - what range may screen_point consist of
         target_range - new range: half negative, half poisitive
 
@@ -72,8 +163,19 @@ class DataProcessor():
         target_range: 500
             <-128; 128) -> <-250; 250)
         '''
+        if isinstance(screen_point, np.ndarray):
+            # widen to avoid overflow of narrow sample types
+            screen_point = screen_point.astype(np.float64)
         return (screen_point+2**(point_bits-1))*target_range/2**point_bits - target_range/2
 
+    def decoded_head(self) -> dict:
+        '''
+        HEAD json of the stored data
+        '''
+        if self._decoded_head[0] is not self.head and self._decoded_head[0] != self.head:
+            self._decoded_head = (self.head, json.loads(self.head[5:].decode('utf-8')))
+        return self._decoded_head[1]
+
     def get_real_values(self, channel: int):
         '''
         convert rawdata where each point represents height on the screen <-128; 127> to
@@ -85,22 +187,533 @@ class DataProcessor():
         if channel not in range(1,3):
             raise Exception('only channels {list(range(1,3)} are allowed')
 
-        head=json.loads(self.head[5:].decode('utf-8'))
         rawdata = self.ch1_data if channel == 1 else self.ch2_data
-        chan = head['CHANNEL'][channel-1]
+        chan = self.decoded_head()['CHANNEL'][channel-1]
+
+        samples = DataProcessor.samples_to_ints(memoryview(rawdata)[5:])
+        return screen_to_volts(samples, chan).tolist()
+
+class CaptureWriter:
+    '''
+    appends frames to segmented capture: <dir>/<segment number>.cap holding CAPTURE_MAGIC followed by FRAME messages and
+    <dir>/<segment number>.idx holding CAPTURE_INDEX_ENTRY per frame
+
+    header is embedded (FRAME_FLAG_HEAD) only into the first frame of a segment and frames where it changed, so each segment is self-contained;
+    new segment is started once the current one exceeds segment_size bytes or segment_time seconds
+    '''
+    def __init__(self, dir_: str, segment_size: int = DEFAULT_SEGMENT_SIZE*2**20, segment_time: float = DEFAULT_SEGMENT_TIME):
+        self.dir = dir_
+        self.segment_size = segment_size
+        self.segment_time = segment_time
+        self.frames_written = 0
+        self._data_file = None
+        self._index_file = None
+        self._segment_started = None
+        self._last_head = None
+        self._header_offset = 0
+        os.makedirs(dir_, exist_ok=True)
+        # never overwrite ... continue after segments of previous runs
+        segments = CaptureReader.list_segments(dir_)
+        self._segment_no = int(os.path.basename(segments[-1])[:-len(CAPTURE_SEGMENT_EXT)])+1 if segments else 0
+        self._frame_no = sum(len(CaptureReader.read_index(segment)) for segment in segments)
+
+    def _start_segment(self):
+        self.close()
+        path = os.path.join(self.dir, f'{self._segment_no:06}')
+        self._segment_no += 1
+        self._data_file = open(path+CAPTURE_SEGMENT_EXT, 'xb')
+        self._data_file.write(CAPTURE_MAGIC)
+        self._index_file = open(path+CAPTURE_INDEX_EXT, 'xb')
+        self._segment_started = time.monotonic()
+        self._last_head = None
+
+    def append(self, proc: DataProcessor):
+        '''
+        stores the frame currently held by proc
+        '''
+        if proc.head is None:
+            # index entry would point to no header
+            raise Exception('frame without header cannot be stored')
+        if self._data_file is None or self._data_file.tell() >= self.segment_size or time.monotonic()-self._segment_started >= self.segment_time:
+            self._start_segment()
+        offset = self._data_file.tell()
+        with_header = proc.head != self._last_head
+        msg = proc.make_frame_msg(with_header, self.frames_written, time.time())
+        if with_header:
+            self._last_head = proc.head
+            self._header_offset = offset
+        seq, t_start = struct.unpack_from('<Qd', msg, 5)
+        self._data_file.write(msg)
+        self._data_file.flush()
+        # index is written after the data so that it never points beyond the data
+        self._index_file.write(CAPTURE_INDEX_ENTRY.pack(self._frame_no, seq, t_start, offset, len(msg), self._header_offset))
+        self._index_file.flush()
+        self._frame_no += 1
+        self.frames_written += 1
+
+    def close(self):
+        for f in (self._data_file, self._index_file):
+            if f:
+                f.close()
+        self._data_file = self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class CaptureReader:
+    '''
+    random access to frames of a capture stored by CaptureWriter; segments are memory-mapped and frames are
+    located through the index, so seeking to any frame is O(1) and channels are zero-copy views
+
+    Example of usage:
+        with CaptureReader('dump') as capture:
+            frame = capture.frame(capture.find(time.time()-60))
+            print(frame['seq'], frame['channels'][1][:10])
+    '''
+    def __init__(self, dir_: str):
+        self.dir = dir_
+        self.segments = CaptureReader.list_segments(dir_)
+        indexes = []
+        for segment in self.segments:
+            indexes.append(CaptureReader.read_index(segment, sum(map(len, indexes))))
+        # offset table of all frames (cf. CAPTURE_INDEX_DTYPE) and number of the segment holding each of them
+        self.index = np.concatenate(indexes) if indexes else np.empty(0, dtype=CAPTURE_INDEX_DTYPE)
+        self.segment_of = np.repeat(np.arange(len(indexes)), [len(i) for i in indexes])
+        self.names = [os.path.join(dir_, f'{frame:08}_{seq}.dat') for frame, seq in zip(self.index['frame'], self.index['seq'])]
+        # t_start need not increase (dumps merged by convert_dat_dumps(), capture continued after relay restart) ... find() then goes through the order by t_start
+        t_start = self.index['t_start']
+        self._t_order = None if (np.diff(t_start) >= 0).all() else np.argsort(t_start, kind='stable')
+        self._t_sorted = t_start if self._t_order is None else t_start[self._t_order]
+        self._maps = {}
+
+    @staticmethod
+    def list_segments(dir_: str) -> list:
+        return sorted(os.path.join(dir_, f) for f in os.listdir(dir_) if f.endswith(CAPTURE_SEGMENT_EXT)) if os.path.isdir(dir_) else []
+
+    @staticmethod
+    def is_capture(path: str) -> bool:
+        return bool(CaptureReader.list_segments(path))
 
-        RANGE_OF_OFFSET_ON_THE_SCREEN=500
-        return list(map(lambda x: (DataProcessor.map_screen_data_point_to_range(x, target_range=RANGE_OF_OFFSET_ON_THE_SCREEN, point_bits=8)-chan['OFFSET'])*scale_to_float(chan['SCALE'])/5, DataProcessor.samples_to_ints(rawdata[5:])))
+    @staticmethod
+    def read_index(segment: str, first: int = 0) -> np.ndarray:
+        '''
+        entries of the segment index; the index is rebuilt by scanning the segment when it is missing
+        (its frames are numbered from first)
+        '''
+        index_path = segment[:-len(CAPTURE_SEGMENT_EXT)]+CAPTURE_INDEX_EXT
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            # entry being written while interrupted is ignored
+            return np.frombuffer(data, dtype=CAPTURE_INDEX_DTYPE, count=len(data)//CAPTURE_INDEX_DTYPE.itemsize)
+        return CaptureReader.scan_segment(segment, first)
+
+    @staticmethod
+    def scan_segment(segment: str, first: int = 0) -> np.ndarray:
+        entries = []
+        with open(segment, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+                raise Exception(f"'{segment}' is not a capture segment")
+            offset = len(CAPTURE_MAGIC)
+            header_offset = offset
+            while offset+5 <= len(data):
+                length = 5+int.from_bytes(data[offset+1:offset+5], 'little', signed=False)
+                if offset+length > len(data):
+                    # frame being written while interrupted
+                    break
+                seq, t_start, _, _, flags, _ = FRAME_FIELDS.unpack_from(data, offset+5)
+                if flags & FRAME_FLAG_HEAD:
+                    header_offset = offset
+                entries.append((first+len(entries), seq, t_start, offset, length, header_offset))
+                offset += length
+        return np.array(entries, dtype=CAPTURE_INDEX_DTYPE)
+
+    def _map(self, segment_no: int) -> memoryview:
+        if segment_no not in self._maps:
+            with open(self.segments[segment_no], 'rb') as f:
+                self._maps[segment_no] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._maps[segment_no])
+
+    def close(self):
+        '''
+        views returned by frame() must not be used afterwards
+        '''
+        for mm in self._maps.values():
+            try:
+                mm.close()
+            except BufferError:
+                # views are still referenced ... mapping is released along with them
+                pass
+        self._maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def mtime(self, i: int) -> float:
+        '''
+        modification time of the file holding the i-th frame
+        '''
+        return os.path.getmtime(self.segments[self.segment_of[i]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, t: float) -> int:
+        '''
+        index of the earliest frame acquired at t or later (len(self) when there is none)
+        '''
+        pos = int(np.searchsorted(self._t_sorted, t))
+        if self._t_order is None or pos == len(self):
+            return pos
+        return int(self._t_order[pos])
+
+    def frame(self, i: int) -> dict:
+        '''
+        as decode_frame_msg() without 'encodings' (channels are stored raw) and with 'head' (HEAD json) and channels as np.int8 arrays,
+        all zero-copy views on the mapped segment; same fields as DatReader.frame()
+        '''
+        entry = self.index[i]
+        mv = self._map(self.segment_of[i])
+        offset, header_offset = int(entry['offset']), int(entry['header_offset'])
+        frame = decode_frame_msg(mv[offset:offset+int(entry['length'])])
+        header_len = 5+int.from_bytes(mv[header_offset+1:header_offset+5], 'little', signed=False)
+        frame['header'] = decode_frame_msg(mv[header_offset:header_offset+header_len])['header']
+        frame['head'] = frame['header'][4:]
+        frame['channels'] = {ch: DataProcessor.samples_to_ints(data) for ch, data in frame['channels'].items()}
+        frame.pop('encodings', None)
+        return frame
+
+    def __getitem__(self, i: int) -> bytes:
+        '''
+        dump object (HEAD message followed by FRAME message without header) of the i-th frame
+        '''
+        frame = self.frame(i)
+        return bytes([WS_TYPES.HEAD.value])+frame['header']+encode_frame_msg(frame['seq'], frame['t_start'], frame['t_end'], frame['header_id'], None, frame['channels'])
+
+def parse_dat_name(path: str) -> tuple:
+    '''
+    (count, unix time) from the name of .dat dump '<count>_<%Y-%m-%d_%H-%M-%S.%f>.dat' (cf. RelayDump.dump()); (None, None) for other names
+    '''
+    name = os.path.basename(path)[:-4]
+    try:
+        return int(name.split('_', 1)[0]), datetime.strptime(name.split('_', 1)[1].rstrip(')'), '%Y-%m-%d_%H-%M-%S.%f').timestamp()
+    except (ValueError, IndexError):
+        return None, None
+
+class DatReader:
+    '''
+    same access as CaptureReader to per-frame .dat dumps: files are memory-mapped on first access and their fields located in one pass
+    (the last DAT_CACHE_SIZE frames are kept)
+    '''
+    def __init__(self, files: list):
+        self.names = list(files)
+        self._frames = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def mtime(self, i: int) -> float:
+        return os.path.getmtime(self.names[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self._frames.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def parse_dump(mv: memoryview) -> dict:
+        '''
+        dump object (cf. DataProcessor.make_dump_obj()) -> as CaptureReader.frame(); seq, t_start, t_end and header_id are None for legacy dumps
+        (cf. frame() taking them from the name)
+        '''
+        frame = {'seq': None, 't_start': None, 't_end': None, 'header_id': None, 'header': None, 'head': None, 'channels': {}}
+        for msg_type, offset, length in DataProcessor.field_offsets(mv):
+            field = mv[offset:offset+length]
+            if msg_type == WS_TYPES.HEAD.value:
+                frame['header'] = field[1:]
+            elif msg_type == WS_TYPES.FRAME.value:
+                frame.update({k: v for k, v in decode_frame_msg(field).items() if k != 'header' or v is not None})
+            else:
+                frame['channels'][msg_type] = field[5:]
+        if frame['header'] is not None:
+            frame['head'] = frame['header'][4:]
+        frame['channels'] = {ch: DataProcessor.samples_to_ints(data) for ch, data in frame['channels'].items()}
+        frame.pop('encodings', None)
+        return frame
+
+    @staticmethod
+    def fill_from_name(frame: dict, name: str) -> dict:
+        '''
+        seq and timestamps of legacy dump are taken from its name (acquisition end is not known ... same as its start)
+        '''
+        if frame['t_start'] is None:
+            frame['seq'], frame['t_start'] = parse_dat_name(name)
+            frame['t_end'] = frame['t_start']
+        return frame
+
+    def frame(self, i: int) -> dict:
+        '''
+        cf. parse_dump() and fill_from_name()
+        '''
+        if i in self._frames:
+            self._frames.move_to_end(i)
+            return self._frames[i]
+        with open(self.names[i], 'rb') as f:
+            mv = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if os.fstat(f.fileno()).st_size else memoryview(b'')
+        self._frames[i] = DatReader.fill_from_name(DatReader.parse_dump(mv), self.names[i])
+        if len(self._frames) > DAT_CACHE_SIZE:
+            self._frames.popitem(last=False)
+        return self._frames[i]
+
+    def __getitem__(self, i: int) -> bytes:
+        with open(self.names[i], 'rb') as f:
+            return f.read()
+
+class ArchiveReader(DatReader):
+    '''
+    same access as CaptureReader to .dat dumps packed in zip or tar (optionally compressed) archive
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        if zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(path)
+            self._tar = None
+            members = [m for m in self._zip.namelist() if m.endswith('.dat')]
+        else:
+            self._zip = None
+            self._tar = tarfile.open(path)
+            self._members = {m.name: m for m in self._tar.getmembers() if m.isfile() and m.name.endswith('.dat')}
+            members = list(self._members)
+        super().__init__(sorted(members))
+
+    @staticmethod
+    def is_archive(path: str) -> bool:
+        return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+    def close(self):
+        super().close()
+        if self._zip:
+            self._zip.close()
+        if self._tar:
+            self._tar.close()
+
+    def mtime(self, i: int) -> float:
+        return os.path.getmtime(self.path)
+
+    def __getitem__(self, i: int) -> bytes:
+        if self._zip:
+            return self._zip.read(self.names[i])
+        return self._tar.extractfile(self._members[self.names[i]]).read()
+
+    def frame(self, i: int) -> dict:
+        if i in self._frames:
+            self._frames.move_to_end(i)
+            return self._frames[i]
+        self._frames[i] = DatReader.fill_from_name(DatReader.parse_dump(memoryview(self[i])), self.names[i])
+        if len(self._frames) > DAT_CACHE_SIZE:
+            self._frames.popitem(last=False)
+        return self._frames[i]
+
+def open_reader(source: tuple):
+    '''
+    source - ('capture', dir), ('archive', file) or ('dat', [files]) as returned by find_source()
+    '''
+    kind, arg = source
+    if kind == 'capture':
+        return CaptureReader(arg)
+    return ArchiveReader(arg) if kind == 'archive' else DatReader(arg)
+
+def find_source(path: str, neighbors: bool = False) -> tuple:
+    '''
+    neighbors - single .dat file is accompanied by all .dat files of its dir
+    '''
+    if CaptureReader.is_capture(path):
+        # frames of capture are named '<capture dir>/<frame number>_<seq>.dat'
+        return ('capture', path)
+    if ArchiveReader.is_archive(path):
+        # zip or tar of .dat files
+        return ('archive', path)
+    if os.path.isdir(path):
+        files = []
+        for root, dir_, fs in os.walk(path):
+            files.extend(map(lambda f: os.path.join(root, f), filter(lambda f: f.endswith('.dat'), fs)))
+        return ('dat', sorted(files))
+    if neighbors:
+        f_dir = os.path.dirname(path) or '.'
+        return ('dat', sorted(os.path.join(f_dir, f) for f in os.listdir(f_dir) if f.endswith('.dat')))
+    return ('dat', [path])
+
+class FrameTrigger:
+    '''
+    recording rules evaluated on each complete frame held by DataProcessor; frame matches when any of the set rules matches
+
+    above, below - any sample of a checked channel is above/below given voltage
+    change - any sample of a checked channel differs from the previous frame by more than given voltage
+    header - header (settings of the oscilloscope) changed
+    channels - channels checked by the voltage rules
+    '''
+    def __init__(self, above: float = None, below: float = None, change: float = None, header: bool = False, channels: tuple = (1, 2)):
+        self.above = above
+        self.below = below
+        self.change = change
+        self.header = header
+        self.channels = channels
+        self._prev_head = None
+        self._prev_volts = {}
+        self._decoded_head = None
+
+    def matches(self, proc: DataProcessor) -> list:
+        '''
+        returns reasons of the match (empty when the frame does not match)
+        '''
+        reasons = []
+        if proc.head != self._prev_head:
+            if self.header and self._prev_head is not None:
+                reasons.append('header')
+            self._prev_head = proc.head
+            self._decoded_head = proc.decoded_head()
+        for ch in self.channels:
+            rawdata = proc.ch1_data if ch == 1 else proc.ch2_data
+            if not rawdata:
+                self._prev_volts.pop(ch, None)
+                continue
+            volts = screen_to_volts(DataProcessor.samples_to_ints(memoryview(rawdata)[5:]), self._decoded_head['CHANNEL'][ch-1])
+            if self.above is not None and (volts > self.above).any():
+                reasons.append(f'CH{ch} above {self.above} V')
+            if self.below is not None and (volts < self.below).any():
+                reasons.append(f'CH{ch} below {self.below} V')
+            prev = self._prev_volts.get(ch)
+            if self.change is not None and prev is not None and len(prev) == len(volts) and (np.abs(volts-prev) > self.change).any():
+                reasons.append(f'CH{ch} changed by more than {self.change} V')
+            self._prev_volts[ch] = volts
+        return reasons
+
+class TriggeredRecorder:
+    '''
+    passes to store only the frames around those matching the trigger: pre frames preceding the match (kept in memory) and
+    post frames following it; another match within the post frames prolongs the window
+    '''
+    def __init__(self, store: Callable[[DataProcessor], None], trigger: FrameTrigger, pre: int = 0, post: int = 0):
+        self.store = store
+        self.trigger = trigger
+        self.post = post
+        self.pre_frames = collections.deque(maxlen=pre) if pre > 0 else None
+        self.post_remaining = 0
+        self.triggers = 0
+        self.stored = 0
+
+    def on_frame(self, proc: DataProcessor):
+        reasons = self.trigger.matches(proc)
+        if reasons:
+            self.triggers += 1
+            if not self.post_remaining:
+                print(f"frame {proc.seq} triggered recording: {', '.join(reasons)}")
+            while self.pre_frames:
+                self._store(self.pre_frames.popleft())
+            self._store(proc)
+            self.post_remaining = self.post
+        elif self.post_remaining > 0:
+            self._store(proc)
+            self.post_remaining -= 1
+        elif self.pre_frames is not None:
+            # fields of DataProcessor are replaced (not modified) by the following frames ... shallow copy is enough
+            self.pre_frames.append(copy.copy(proc))
+
+    def _store(self, proc: DataProcessor):
+        self.store(proc)
+        self.stored += 1
+
+def convert_dat_dumps(src_dir: str, writer: CaptureWriter) -> int:
+    '''
+    appends per-frame .dat dumps of src_dir (in the order of their names) to the capture; returns number of converted dumps
+    '''
+    files = sorted(os.path.join(root, f) for root, _, files in os.walk(src_dir) for f in files if f.endswith('.dat'))
+    converted = 0
+    for path in files:
+        proc = DataProcessor()
+        with open(path, 'rb') as f:
+            proc.load_dump_obj(f.read())
+        if proc.head is None:
+            print(f"skipping '{path}': no header")
+            continue
+        if proc.seq is None:
+            # legacy dump: seq and timestamp are taken from its name
+            proc.seq, proc.t_start = parse_dat_name(path)
+            if proc.t_start is None:
+                proc.seq = writer.frames_written
+                proc.t_start = os.path.getmtime(path)
+        writer.append(proc)
+        converted += 1
+    return converted
+
+class RelayDump:
+    '''
+    dumps complete frames of single relay to dir_ (all of them or only those selected by TriggeredRecorder when trigger is set)
+    '''
+    def __init__(self, dir_: str, fmt: DUMP_FORMATS = DUMP_FORMATS.CAPTURE, segment_size: int = DEFAULT_SEGMENT_SIZE*2**20, segment_time: float = DEFAULT_SEGMENT_TIME,
+            trigger: FrameTrigger = None, pre: int = 0, post: int = 0):
+        self.dir = dir_
+        self.proc = DataProcessor()
+        self.dump_count = 0
+        self.writer = None
+        if fmt == DUMP_FORMATS.CAPTURE:
+            self.writer = CaptureWriter(dir_, segment_size, segment_time)
+        else:
+            os.makedirs(dir_, exist_ok=True)
+        self.recorder = TriggeredRecorder(self.dump, trigger, pre, post) if trigger else None
+
+    def dump(self, p: DataProcessor):
+        if self.writer:
+            self.writer.append(p)
+        else:
+            ts = (datetime.fromtimestamp(p.t_start) if p.t_start else datetime.now()).strftime('%Y-%m-%d_%H-%M-%S.%f)')[:-4]
+            with open(f"{self.dir}/{self.dump_count:08}_{ts}.dat", 'wb') as dump_file:
+                dmp = p.make_dump_obj()
+                dump_file.write(dmp)
+        self.dump_count += 1
+
+    def on_data(self, new_data):
+        if self.proc.store_live_data(new_data):
+            if self.recorder:
+                self.recorder.on_frame(self.proc)
+            else:
+                self.dump(self.proc)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.recorder:
+            print(f"'{self.dir}': recording triggered {self.recorder.triggers} times, {self.recorder.stored} frames recorded")
+        if self.proc.missed_frames:
+            print(f"'{self.dir}': frames missed (dropped by the relay): {self.proc.missed_frames}")
 
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Display current oscilloscope curves as forwarded by target relay.")
     parser.add_argument(
         "-t",
         "--host",
-        help="Host of the oscilloscope relay.",
+        help="Host of the oscilloscope relay as 'host' or 'host:port'. When multiple relays are passed, each one is dumped to its own subdirectory 'host_port' of --dir.",
         type=str,
-        nargs='?',
-        default=DEFAULT_HOST,
+        nargs='*',
+        default=[DEFAULT_HOST],
     )
     parser.add_argument(
         "-p",
@@ -118,43 +731,128 @@ def build_parser() -> argparse.ArgumentParser:
         nargs='?',
         default=DEFAULT_DUMP_DIR,
     )
+    parser.add_argument(
+        "-e",
+        "--encoding",
+        help="Encoding of channels data sent by the relay: 'zlib' or 'delta' save bandwidth of slow links.",
+        type=str,
+        choices=[e.value for e in WS_ENCODINGS],
+        nargs='?',
+        default=WS_ENCODINGS.RAW.value,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        help="Format of the dump: 'capture' appends frames to segmented files with index (cf. CaptureReader), 'dat' stores single file per frame.",
+        type=str,
+        choices=[f.value for f in DUMP_FORMATS],
+        nargs='?',
+        default=DUMP_FORMATS.CAPTURE.value,
+    )
+    parser.add_argument(
+        "--segment-size",
+        help="Start new capture segment once the current one exceeds given size in MB.",
+        type=float,
+        nargs='?',
+        default=DEFAULT_SEGMENT_SIZE,
+    )
+    parser.add_argument(
+        "--segment-time",
+        help="Start new capture segment once the current one is older than given number of seconds.",
+        type=float,
+        nargs='?',
+        default=DEFAULT_SEGMENT_TIME,
+    )
+    parser.add_argument(
+        "--above",
+        help="Record only frames where any sample of a checked channel is above given voltage (and frames around them, cf. --pre, --post).",
+        type=float,
+        nargs='?',
+        default=None,
+    )
+    parser.add_argument(
+        "--below",
+        help="Record only frames where any sample of a checked channel is below given voltage.",
+        type=float,
+        nargs='?',
+        default=None,
+    )
+    parser.add_argument(
+        "--change",
+        help="Record only frames where any sample of a checked channel differs from the previous frame by more than given voltage.",
+        type=float,
+        nargs='?',
+        default=None,
+    )
+    parser.add_argument(
+        "--header-change",
+        help="Record only frames where settings of the oscilloscope changed.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--channels",
+        help="Channels checked by --above, --below and --change.",
+        type=int,
+        choices=[1, 2],
+        nargs='*',
+        default=[1, 2],
+    )
+    parser.add_argument(
+        "--pre",
+        help="Number of frames preceding the frame matching the recording rules to be recorded as well.",
+        type=int,
+        nargs='?',
+        default=0,
+    )
+    parser.add_argument(
+        "--post",
+        help="Number of frames following the frame matching the recording rules to be recorded as well.",
+        type=int,
+        nargs='?',
+        default=0,
+    )
+    parser.add_argument(
+        "--convert",
+        help="Convert per-frame .dat dumps of given directory to capture stored in --dir and exit.",
+        type=str,
+        nargs='?',
+        default=None,
+    )
     return parser
 
-exit_app = False
 if __name__ == "__main__":
     parser = build_parser()
     pargs = parser.parse_args(sys.argv[1:])
 
-    def _sig_exit(signum, frame):
-        global exit_app
-        print("Exiting ...")
-        exit_app = True
-    signal.signal(signal.SIGINT, _sig_exit)
-    signal.signal(signal.SIGTERM, _sig_exit)
-    def should_continue():
-        global exit_app
-        return not exit_app
+    if pargs.convert:
+        with CaptureWriter(pargs.dir, int(pargs.segment_size*2**20), pargs.segment_time) as writer:
+            count = convert_dat_dumps(pargs.convert, writer)
+        print(f"converted {count} dumps of '{pargs.convert}' to capture '{pargs.dir}'")
+        sys.exit(0)
 
-    rcvr = LiveReceiver(pargs.host, pargs.port)
-    proc = DataProcessor()
+    targets = [parse_target(t, pargs.port) for t in pargs.host]
+    dumps = {}
+    async def dump_relays():
+        clients = [RelayClient(host, port, WS_ENCODINGS(pargs.encoding)) for host, port in targets]
+        for client, (host, port) in zip(clients, targets):
+            trigger = None
+            if pargs.above is not None or pargs.below is not None or pargs.change is not None or pargs.header_change:
+                trigger = FrameTrigger(pargs.above, pargs.below, pargs.change, pargs.header_change, tuple(pargs.channels))
+            dump_dir = pargs.dir if len(targets) == 1 else os.path.join(pargs.dir, f'{host}_{port}')
+            dumps[client] = RelayDump(dump_dir, DUMP_FORMATS(pargs.format), int(pargs.segment_size*2**20), pargs.segment_time, trigger, pargs.pre, pargs.post)
 
-    try:
-        os.mkdir(pargs.dir)
-    except Exception:
-        pass
-
-    global dump_count
-    dump_count = 0
-    def store_data(new_data):
-        global dump_count
-        proc.store_live_data(new_data)
-        # presume each time CH2_DATA comes, all necessary data were received for the dump to be complete
-        LAST_MESSAGE = 'CH2_DATA'
-        if WS_TYPES(new_data[0]).name == LAST_MESSAGE:
-            ts = datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f)')[:-4]
-            with open(f"{pargs.dir}/{dump_count:08}_{ts}.dat", 'wb') as dump_file:
-                dmp = proc.make_dump_obj()
-                dump_file.write(dmp)
-            dump_count += 1
+        def _sig_exit():
+            print("Exiting ...")
+            for client in clients:
+                client.close()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, _sig_exit)
+
+        for client in clients:
+            client.start()
+        async for client, new_data in merge(clients):
+            dumps[client].on_data(new_data)
 
-    rcvr.start(store_data, should_continue)
+    asyncio.run(dump_relays())
+    for d in dumps.values():
+        d.close()
@@ -3,25 +3,126 @@ import os
 import sys
 import argparse
 import json
+import struct
+import asyncio
 
-import multiprocessing, multiprocessing.connection
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
 
 from matplotlib.animation import FuncAnimation
 import matplotlib.pyplot as plt
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from relay_srv import DEFAULT_PORT, WS_TYPES
+from relay_srv import DEFAULT_PORT, WS_ENCODINGS
 from osc_plot import Plotter
-from live_dump import LiveReceiver, DataProcessor
+from live_dump import DataProcessor
+from relay_client import RelayClient
 DEFAULT_HOST="localhost"
 
 ch1_color="#eed807"
 ch2_color="#67c7ff"
 
-head_json = None
-ch1_data = []
-ch2_data = []
-def plot_cont(consumer_conn: multiprocessing.connection.Connection):
+MAJOR_SCREEN_DIVISION=10
+
+class SharedFrameBuffer:
+    '''
+    passes the latest frame from the receiver to the plotting process through shared memory without pickling;
+    frames are written alternately to two slots and the counter of published frames tells which slot holds the latest complete one;
+    copy of a slot is valid only when the counter did not change meanwhile (it is retried otherwise)
+
+    [ counter | 8B 'little endian' ][ slot 0 ][ slot 1 ]
+    slot: [ SLOT_FIELDS: header version, header length, CH1 and CH2 samples count ][ HEAD json ][ CH1 8-bit samples ][ CH2 8-bit samples ]
+    '''
+    SLOT_FIELDS = struct.Struct('<QIII')
+    MAX_HEAD_LEN = 8192
+    MAX_SAMPLES = 16384
+
+    def __init__(self, name: str = None):
+        '''
+        name - attach to the buffer created by another process, new one is created when not set
+        '''
+        self.slot_size = self.SLOT_FIELDS.size + self.MAX_HEAD_LEN + 2*self.MAX_SAMPLES
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=8+2*self.slot_size)
+            self.shm.buf[:8] = bytes(8)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if multiprocessing.get_start_method() != 'fork':
+                # spawned process has its own resource tracker which would unlink the memory at exit ... the creator is responsible for it
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.published = 0
+        self.head_version = 0
+        self._last_head = None
+        self.read_counter = 0
+        self._read_head_version = None
+
+    def _counter(self) -> int:
+        return int.from_bytes(self.shm.buf[:8], 'little')
+
+    def publish(self, head: bytes, channels: dict):
+        '''
+        head - HEAD json
+        channels - {channel: 8-bit samples}, missing or None for channels not displayed
+        '''
+        if head != self._last_head:
+            self._last_head = bytes(head)
+            self.head_version += 1
+        lens = [len(channels.get(ch) or b'') for ch in range(1,3)]
+        if len(head) > self.MAX_HEAD_LEN or max(lens) > self.MAX_SAMPLES:
+            raise Exception(f'frame does not fit into shared buffer: head {len(head)} B, samples {lens}')
+        counter = self.published+1
+        buf = self.shm.buf
+        off = 8 + (counter%2)*self.slot_size
+        self.SLOT_FIELDS.pack_into(buf, off, self.head_version, len(head), *lens)
+        off += self.SLOT_FIELDS.size
+        buf[off:off+len(head)] = head
+        off += self.MAX_HEAD_LEN
+        for ch, l in zip(range(1,3), lens):
+            if l:
+                buf[off:off+l] = channels[ch]
+            off += self.MAX_SAMPLES
+        # frame is complete ... make it visible to the reader
+        buf[:8] = counter.to_bytes(8, 'little')
+        self.published = counter
+
+    def latest(self) -> dict:
+        '''
+        {'head': HEAD json (None when not changed since the last returned frame), 'channels': {channel: np.int8 samples}, 'skipped': frames never returned}
+        copied out of the latest complete frame; None when there is no frame newer than the last returned one
+        '''
+        buf = self.shm.buf
+        while True:
+            counter = self._counter()
+            if counter == self.read_counter:
+                return None
+            off = 8 + (counter%2)*self.slot_size
+            head_version, head_len, *lens = self.SLOT_FIELDS.unpack_from(buf, off)
+            off += self.SLOT_FIELDS.size
+            head = bytes(buf[off:off+head_len]) if head_version != self._read_head_version else None
+            off += self.MAX_HEAD_LEN
+            channels = {}
+            for ch, l in zip(range(1,3), lens):
+                if l:
+                    channels[ch] = np.frombuffer(buf, dtype=np.int8, count=l, offset=off).copy()
+                off += self.MAX_SAMPLES
+            if self._counter() == counter:
+                # nothing was published while copying ... the writer starts overwriting this slot only after publishing the next frame
+                skipped = counter-self.read_counter-1
+                self.read_counter = counter
+                self._read_head_version = head_version
+                return {'head': head, 'channels': channels, 'skipped': skipped}
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def plot_cont(shared_name: str):
+    shared = SharedFrameBuffer(shared_name)
     plotter = Plotter()
     fig, ax = plotter.init_plot([ch1_color, ch2_color])
 
@@ -31,6 +132,7 @@ def plot_cont(consumer_conn: multiprocessing.connection.Connection):
     ln1, = plt.plot([], [], color=ch1_color)
     ln2, = plt.plot([], [], color=ch2_color)
     lines = [ln1, ln2]
+    head_json = None
 
     def on_new_head():
         plotter.apply_head(head_json)
@@ -40,42 +142,25 @@ def plot_cont(consumer_conn: multiprocessing.connection.Connection):
         on_new_head()
         return lines
     def update(frame):
-        global ch1_data
-        global ch2_data
-        global head_json
-        #print(f"update {frame}")
-        while consumer_conn.poll():
-            d=consumer_conn.recv()
-            if d['type'] == 'HEAD':
-                head_json = d['data']
-                on_new_head()
-            elif d['channel'] == 1:
-                ch1_data = d['data']
-            elif d['channel'] == 2:
-                ch2_data = d['data']
+        nonlocal head_json
+        # frames received in the meantime are skipped ... only the latest one is rendered
+        d = shared.latest()
+        if d is None:
+            return lines
+        if d['head'] is not None:
+            head_json = json.loads(d['head'].decode('utf-8'))
+            on_new_head()
+        for ch, line in enumerate(lines, 1):
+            samples = d['channels'].get(ch)
+            if samples is None or not head_json or head_json['CHANNEL'][ch-1]['DISPLAY'] == 'OFF':
+                line.set_data([], [])
             else:
-                print(f"unknown data received {d['type']} {d['channel']}")
-        if not head_json or head_json['CHANNEL'][0]['DISPLAY'] == 'OFF':
-            lines[0].set_data([], [])
-        else:
-            lines[0].set_data(x_data_pts_range, ch1_data) if ch1_data else None
-        if not head_json or head_json['CHANNEL'][1]['DISPLAY'] == 'OFF':
-            lines[1].set_data([], [])
-        else:
-            lines[1].set_data(x_data_pts_range, ch2_data) if ch2_data else None
+                line.set_data(x_data_pts_range, DataProcessor.map_screen_data_point_to_range(samples, MAJOR_SCREEN_DIVISION, 8))
         return lines
 
     ani = FuncAnimation(fig, update, cache_frame_data=False, interval=30, init_func=init, blit=True)
     plt.show()
-
-def process_data_received(rawdata: bytes):
-    if rawdata[0] == 0:
-        data=json.loads(rawdata[5:].decode('utf-8'))
-    else:
-        channel=rawdata[0]
-        MAJOR_SCREEN_DIVISION=10
-        data=list(map(lambda x: DataProcessor.map_screen_data_point_to_range(x, MAJOR_SCREEN_DIVISION, 8), DataProcessor.samples_to_ints(rawdata[5:])))
-    return {'type': WS_TYPES(rawdata[0]).name, 'channel': rawdata[0], 'data': data}
+    shared.close()
 
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Display current oscilloscope curves as forwarded by target relay.")
@@ -95,19 +180,34 @@ def build_parser() -> argparse.ArgumentParser:
         nargs='?',
         default=DEFAULT_PORT,
     )
+    parser.add_argument(
+        "-e",
+        "--encoding",
+        help="Encoding of channels data sent by the relay: 'zlib' or 'delta' save bandwidth of slow links.",
+        type=str,
+        choices=[e.value for e in WS_ENCODINGS],
+        nargs='?',
+        default=WS_ENCODINGS.RAW.value,
+    )
     return parser
 
 if __name__ == "__main__":
     parser = build_parser()
     pargs = parser.parse_args(sys.argv[1:])
 
-    producer_conn, consumer_conn = multiprocessing.Pipe()
-    p = multiprocessing.Process(target=plot_cont, args=(consumer_conn,))
+    shared = SharedFrameBuffer()
+    p = multiprocessing.Process(target=plot_cont, args=(shared.name,))
     p.start()
 
-    def pass_to_consumer(rawdata):
-        producer_conn.send(process_data_received(rawdata))
-    rcvr = LiveReceiver(pargs.host, pargs.port)
-    rcvr.start(pass_to_consumer, p.is_alive)
+    async def receive():
+        proc = DataProcessor()
+        # small buffer ... only the latest frame is displayed anyway
+        async with RelayClient(pargs.host, pargs.port, WS_ENCODINGS(pargs.encoding), buffer_size=2) as client:
+            while p.is_alive():
+                rawdata = await client.get(timeout=0.5)
+                if rawdata is not None and proc.store_live_data(rawdata) and proc.head:
+                    shared.publish(memoryview(proc.head)[5:], {ch: memoryview(data)[5:] for ch, data in ((1, proc.ch1_data), (2, proc.ch2_data)) if data})
+    asyncio.run(receive())
 
     p.join()
+    shared.close()
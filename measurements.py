@@ -0,0 +1,136 @@
+'''
+waveform measurements of the screen data computed by numpy
+
+Example of usage with OwonPDS6062T:
+    from owonPDS6062T import OwonPDS6062T
+    from measurements import measure_frame
+    o=OwonPDS6062T()
+    print(measure_frame(o.get_header(), {ch: o.get_data(ch) for ch in (1, 2)}))
+'''
+import os
+import sys
+import functools
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from units import scale_to_float, time_scale_to_float
+
+# height of the screen in units of channel OFFSET (50 per division)
+RANGE_OF_OFFSET_ON_THE_SCREEN=500
+# width of the screen in divisions of TIMEBASE SCALE
+SCREEN_DIVISIONS_X=15.2
+# hysteresis of the mid level crossings (fraction of Vpp) so that noise does not make up edges
+EDGE_HYSTERESIS=0.1
+# (OFFSET, SCALE) pairs whose calibration tables are kept
+CALIBRATION_CACHE_SIZE=256
+
+@functools.lru_cache(maxsize=CALIBRATION_CACHE_SIZE)
+def calibration_lut(offset: int, scale: str) -> np.ndarray:
+    '''
+    volts of all 256 possible samples indexed by the sample byte (int8 sample viewed as uint8); read-only
+
+    offset - channel OFFSET states where is zero on the screen <-250; 250>
+    scale - channel SCALE (tenth of division)
+    '''
+    samples = np.arange(256, dtype=np.uint8).view(np.int8)
+    points = (samples.astype(np.float64)+128)*RANGE_OF_OFFSET_ON_THE_SCREEN/256 - RANGE_OF_OFFSET_ON_THE_SCREEN/2
+    lut = (points-offset)*scale_to_float(scale)/5
+    lut.flags.writeable = False
+    return lut
+
+def screen_to_volts(samples: np.ndarray, chan: dict) -> np.ndarray:
+    '''
+    samples - screen heights <-128; 127> (cf. DataProcessor.samples_to_ints())
+    chan - channel desc of HEAD (cf. calibration_lut())
+    '''
+    samples = np.asarray(samples)
+    if samples.dtype != np.int8:
+        samples = samples.astype(np.int8)
+    return calibration_lut(chan['OFFSET'], chan['SCALE'])[samples.view(np.uint8)]
+
+def screen_duration(head: dict) -> float:
+    '''
+    seconds spanned by the screen (horizontally)
+    '''
+    return time_scale_to_float(head['TIMEBASE']['SCALE'])*SCREEN_DIVISIONS_X
+
+def sample_interval(head: dict, points_count: int) -> float:
+    '''
+    seconds between neighboring samples of points_count samples spread over the screen width
+    '''
+    return time_scale_to_float(head['TIMEBASE']['SCALE'])*SCREEN_DIVISIONS_X/points_count
+
+def _crossings(volts: np.ndarray, a: np.ndarray, b: np.ndarray, level: float) -> np.ndarray:
+    '''
+    interpolated positions (in samples) where the signal passes level between samples a and b
+    '''
+    va, vb = volts[a], volts[b]
+    return a + (level-va)/np.where(vb != va, vb-va, 1)*(b-a)
+
+def edges(volts: np.ndarray, level: float, hysteresis: float) -> tuple:
+    '''
+    positions (in samples) of rising and falling crossings of level; the signal has to get beyond level+-hysteresis
+    '''
+    state = np.zeros(len(volts), dtype=np.int8)
+    state[volts > level+hysteresis] = 1
+    state[volts < level-hysteresis] = -1
+    idx = np.flatnonzero(state)
+    states = state[idx]
+    change = np.flatnonzero(states[1:] != states[:-1])
+    pos = _crossings(volts, idx[change], idx[change+1], level)
+    rising = states[change+1] == 1
+    return pos[rising], pos[~rising]
+
+def _upward_crossings(volts: np.ndarray, level: float) -> np.ndarray:
+    i = np.flatnonzero((volts[:-1] < level) & (volts[1:] >= level))
+    return _crossings(volts, i, i+1, level)
+
+def measure(volts: np.ndarray, dt: float) -> dict:
+    '''
+    vmax, vmin, vpp, mean, rms [V]; frequency [Hz], period [s], duty (0 - 1), rise_time (10 % - 90 % of Vpp) [s]
+    those not determinable from the data (e.g. less than 2 rising edges on the screen) are None
+    '''
+    res = {'vmax': None, 'vmin': None, 'vpp': None, 'mean': None, 'rms': None, 'frequency': None, 'period': None, 'duty': None, 'rise_time': None}
+    if not len(volts):
+        return res
+    vmax, vmin = float(volts.max()), float(volts.min())
+    vpp = vmax-vmin
+    res.update({'vmax': vmax, 'vmin': vmin, 'vpp': vpp, 'mean': float(volts.mean()), 'rms': float(np.sqrt(np.mean(np.square(volts))))})
+    if vpp <= 0:
+        return res
+
+    rising, falling = edges(volts, vmin+vpp/2, vpp*EDGE_HYSTERESIS)
+    if len(rising) >= 2:
+        periods = np.diff(rising)
+        res['period'] = float(periods.mean())*dt
+        res['frequency'] = 1/res['period']
+        # falling edge within each full period
+        j = np.searchsorted(falling, rising[:-1])
+        valid = j < len(falling)
+        valid[valid] = falling[j[valid]] < rising[1:][valid]
+        if valid.any():
+            res['duty'] = float(np.mean((falling[j[valid]]-rising[:-1][valid])/periods[valid]))
+
+    up10 = _upward_crossings(volts, vmin+vpp*0.1)
+    up90 = _upward_crossings(volts, vmin+vpp*0.9)
+    # last 10 % crossing preceding each 90 % crossing; only the first 90 % crossing of each edge counts
+    j = np.searchsorted(up10, up90)-1
+    valid = j >= 0
+    j, first = np.unique(j[valid], return_index=True)
+    if len(j):
+        res['rise_time'] = float(np.median(up90[valid][first]-up10[j]))*dt
+    return res
+
+def measure_frame(head: dict, channels: dict) -> dict:
+    '''
+    head - decoded HEAD json
+    channels - {channel: 8-bit screen samples (bytes or numpy array of ints)} of the displayed channels
+    returns {channel: measure()}
+    '''
+    res = {}
+    for ch, samples in channels.items():
+        samples = samples if isinstance(samples, np.ndarray) else np.frombuffer(samples, dtype=np.int8)
+        volts = screen_to_volts(samples, head['CHANNEL'][ch-1])
+        res[ch] = measure(volts, sample_interval(head, len(samples)) if len(samples) else 0.0)
+    return res
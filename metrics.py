@@ -0,0 +1,137 @@
+'''
+relay metrics in Prometheus text exposition format (cf. GET /metrics of relay_srv.py)
+
+Example of usage:
+    m = DeviceMetrics()
+    o.on_timing = m.on_timing
+    o.get_header()
+    print(format_metrics([('owon_usb_command_seconds', 'histogram', 'USB transaction latency', m.command_samples({'device': 'A'}))]))
+'''
+import json
+import time
+import bisect
+import collections
+
+# s
+LATENCY_BUCKETS=(0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+FPS_WINDOW=2.0 # s
+# commands sent via /query may be arbitrary ... the rest is accounted as 'other'
+MAX_COMMANDS=64
+
+class Histogram:
+    '''
+    cumulative histogram of durations in seconds
+    '''
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+def format_metrics(metrics: list) -> str:
+    '''
+    metrics - [(name, type, help, [(labels, value)])]; value of 'histogram' type is Histogram
+    '''
+    lines = []
+    for name, kind, help_, samples in metrics:
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            if kind != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for le, count in zip(list(value.buckets)+['+Inf'], value.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels({**labels, "le": le})} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} {value.count}')
+    return '\n'.join(lines) + '\n'
+
+class DeviceMetrics:
+    '''
+    counters of single oscilloscope; on_timing() is called from the acquisition thread, on_frame() from the asyncio loop
+    '''
+    def __init__(self):
+        self.commands = {} # {command: Histogram} of the whole USB transaction
+        self.stages = collections.Counter() # {stage: seconds} summed over all transactions
+        self.bytes_read = 0
+        self.mismatches = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.acquisition = Histogram()
+        self.delivery = Histogram()
+        self._frame_times = collections.deque()
+
+    def on_timing(self, cmd, timing: dict):
+        '''
+        cf. OwonPDS6062T.on_timing
+        '''
+        cmd = cmd.decode('utf-8', 'replace') if isinstance(cmd, (bytes, bytearray)) else str(cmd)
+        cmd = cmd.split()[0] if cmd.strip() else cmd # arguments of writes would make too many series
+        hist = self.commands.get(cmd)
+        if hist is None:
+            if len(self.commands) >= MAX_COMMANDS:
+                cmd = 'other'
+            hist = self.commands.setdefault(cmd, Histogram())
+        hist.observe(timing['flush'] + timing['write'] + timing['full_read'])
+        for stage in ('flush', 'write', 'first_byte', 'full_read'):
+            self.stages[stage] += timing[stage]
+        self.bytes_read += timing.get('bytes', 0)
+        if timing.get('mismatch'):
+            self.mismatches += 1
+
+    def on_frame(self, frame, now: float = None):
+        '''
+        frame is passed to the clients
+        '''
+        now = now if now else time.time()
+        self.frames += 1
+        self.frame_bytes += sum(len(data) for data in frame.channels.values())
+        self.acquisition.observe(frame.t_end - frame.t_start)
+        self.delivery.observe(max(0.0, now - frame.t_end))
+        self._frame_times.append(now)
+        while self._frame_times and now - self._frame_times[0] > FPS_WINDOW:
+            self._frame_times.popleft()
+
+    def fps(self, now: float = None) -> float:
+        now = now if now else time.time()
+        recent = [t for t in self._frame_times if now - t <= FPS_WINDOW]
+        return len(recent)/FPS_WINDOW
+
+    def command_samples(self, labels: dict) -> list:
+        return [({**labels, 'command': cmd}, hist) for cmd, hist in list(self.commands.items())]
+
+class FrameTrace:
+    '''
+    JSON line per frame with its timing (e.g. to find out how the acquisition rate depends on the timebase)
+    '''
+    def __init__(self, file_name: str):
+        self.f = open(file_name, 'a', buffering=1<<16)
+
+    def write(self, device_id: str, frame, clients: int, now: float = None):
+        now = now if now else time.time()
+        self.f.write(json.dumps({
+            'device': device_id,
+            'seq': frame.seq,
+            't_start': frame.t_start,
+            'acq_ms': (frame.t_end - frame.t_start)*1000,
+            'delivery_ms': (now - frame.t_end)*1000,
+            'header_id': frame.header_id,
+            'bytes': sum(len(data) for data in frame.channels.values()),
+            'clients': clients,
+        }) + '\n')
+
+    def close(self):
+        self.f.close()
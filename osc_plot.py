@@ -12,6 +12,7 @@ from live_dump import DataProcessor
 class Plotter():
     def __init__(self):
         self.head_objs = []
+        self._x_pts_range = (None, None) # (xlim, points)
 
         # Define number of squares in each direction
         self.num_x = 15.2
@@ -126,12 +127,18 @@ class Plotter():
 
                 self.head_objs.extend([at, tt])
 
-    def get_x_pts_range(self, ):
-        x_min, x_max = self.fig_ax[1].get_xlim()
-        return list(map(lambda x: x/100, range(int(x_min*100), int(x_max*100))))
+    def get_x_pts_range(self, ) -> np.ndarray:
+        '''
+        x coordinate of each screen point; computed once per x limits of the plot
+        '''
+        xlim = self.fig_ax[1].get_xlim()
+        if self._x_pts_range[0] != xlim:
+            x_min, x_max = xlim
+            self._x_pts_range = (xlim, np.arange(int(x_min*100), int(x_max*100))/100)
+        return self._x_pts_range[1]
 
 def to_screen(ch_data, bits, screen_major_divisions_count=10):
-    return list(map(lambda pt: DataProcessor.map_screen_data_point_to_range(pt, screen_major_divisions_count, bits), ch_data))
+    return DataProcessor.map_screen_data_point_to_range(np.asarray(ch_data), screen_major_divisions_count, bits).tolist()
 
 def construct_pyplot(head_json: object, ch1_data: [float] = None, ch2_data: [float] = None, title: str = None) -> plt:
     '''
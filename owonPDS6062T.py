@@ -4,51 +4,180 @@ import usb.core
 import usb.util
 
 import json
+import time
 import array
 
+import numpy as np
+
+# size of single Bulk IN read when the size of the response is not known in advance
+RX_CHUNK_SIZE=2000000
+RX_PACKET_SIZE=512
+VENDOR_ID=0x5345
+PRODUCT_ID=0x1234
+
 class OwonPDS6062T:
     sample_bits = 8
 
-    def __init__(self):
-        self._dev = usb.core.find(idVendor=0x5345, idProduct=0x1234) # set PC mode on oscilloscope # Owon PDS6062T Oscilloscope
+    def __init__(self, usb_find=None, serial: str = None, bus: int = None, address: int = None):
+        '''
+        usb_find - replacement for usb.core.find (e.g. fake_osci.FakeOsci().find for testing without the device)
+        serial, bus, address - select one of several connected oscilloscopes (cf. find()), the first one is used when not set
+        '''
+        self._dev = OwonPDS6062T.find(usb_find, serial, bus, address) # set PC mode on oscilloscope # Owon PDS6062T Oscilloscope
 
         if self._dev is None:
             raise ValueError('Device not found')
         else:
             #print(self._dev)
             self._dev.set_configuration()
+        # Bulk IN may hold stale data (e.g. response not read by previous session) ... flush before the first command
+        self._in_dirty = True
+        # per-stage durations (in seconds) of the last _send() call: flush, write, first_byte, full_read;
+        # plus bytes received and mismatch flag set when the response was shorter/longer than announced
+        self.last_timing = {}
+        # optional callback(cmd, timing) invoked after each _send() call
+        self.on_timing = None
+        # reusable receive buffers per length prefixed query, cf. _read_length_prefixed()
+        self._rx_bufs = {}
+        self._rx_chunk = array.array('B', bytes(RX_CHUNK_SIZE))
+
+    @staticmethod
+    def find_all(usb_find=None) -> list:
+        '''
+        all connected oscilloscopes (pyusb devices)
+        '''
+        usb_find = usb_find if usb_find else usb.core.find
+        return list(usb_find(find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID))
+
+    @staticmethod
+    def find(usb_find=None, serial: str = None, bus: int = None, address: int = None):
+        '''
+        first connected oscilloscope matching all the criteria that are set; None when there is none
+
+        address changes whenever the device is reconnected, serial identifies the oscilloscope permanently
+        '''
+        for dev in OwonPDS6062T.find_all(usb_find):
+            if (bus is not None and dev.bus != bus) or (address is not None and dev.address != address):
+                continue
+            if serial is not None and OwonPDS6062T.device_serial(dev) != serial:
+                continue
+            return dev
+        return None
+
+    @staticmethod
+    def device_serial(dev) -> str:
+        '''
+        None when the serial number cannot be read (e.g. missing permissions)
+        '''
+        try:
+            return dev.serial_number
+        except (usb.core.USBError, ValueError, NotImplementedError):
+            return None
+
+    @staticmethod
+    def device_id(dev) -> str:
+        '''
+        serial number of the device, '<bus>-<address>' when it cannot be read
+        '''
+        return OwonPDS6062T.device_serial(dev) or f'{dev.bus}-{dev.address}'
 
     def _flush_Bulk_IN(self):
         result = array.array('B')
         try:
             while True:
-                result.extend(self._dev.read(0x81,2000000,50))
+                result.extend(self._dev.read(0x81,RX_CHUNK_SIZE,50))
         except usb.core.USBTimeoutError:
             return result
 
     def _send(self, cmd):
-        self._flush_Bulk_IN() # << XXX this might actually not be necessary, but in case the response to query was not read fully, the code might crash (because of reading stale data)
+        '''
+        Bulk IN is drained only when the previous response was not read completely
+        (failed or incomplete read, query sent via write()) to avoid reading stale data
+        '''
+        timing = {'flush': 0.0, 'write': 0.0, 'first_byte': 0.0, 'full_read': 0.0, 'bytes': 0, 'mismatch': False}
+        self.last_timing = timing
+        t0 = time.perf_counter()
+        if self._in_dirty:
+            self._flush_Bulk_IN()
+            self._in_dirty = False
+        t1 = time.perf_counter()
+        timing['flush'] = t1 - t0
         # address taken from results of print(dev):   ENDPOINT 0x3: Bulk OUT
         self._dev.write(3,cmd)
+        t2 = time.perf_counter()
+        timing['write'] = t2 - t1
         if (type(cmd) is str and cmd[-1] != '?') or (type(cmd) is bytes and cmd[-1] != b'?'[0]):
+            self._notify_timing(cmd, timing)
             return
-        # address taken from results of print(dev):   ENDPOINT 0x81: Bulk IN
-        result = (self._dev.read(0x81,2000000,3000))
-        if (not self._query_begins_with_4B_msg_length(str(cmd)) or
+        self._in_dirty = True # until the response is read fully
+        # REST API passes commands as bytes ... str(b'...') would not match any prefix
+        if (not self._query_begins_with_4B_msg_length(cmd.decode('utf-8', 'replace') if type(cmd) is bytes else str(cmd)) or
                 (type(cmd) is str and cmd[0] == '*') or
                 (type(cmd) is bytes and cmd[0] == b'*'[0])):
+            # address taken from results of print(dev):   ENDPOINT 0x81: Bulk IN
+            result = (self._dev.read(0x81,RX_CHUNK_SIZE,3000))
+            timing['first_byte'] = timing['full_read'] = time.perf_counter() - t2
+            timing['bytes'] = len(result)
+            self._in_dirty = False
+            self._notify_timing(cmd, timing)
             return result
-        expected_data_len=int.from_bytes(result[:4], 'little', signed=False)
+        result = self._read_length_prefixed(cmd, timing, t2)
+        self._in_dirty = False
+        self._notify_timing(cmd, timing)
+        return result
+
+    def _rx_buffer(self, cmd, size: int) -> array.array:
+        '''
+        reusable receive buffer dedicated to responses of cmd, at least size bytes long (rounded up to whole USB packets)
+        '''
+        buf = self._rx_bufs.get(cmd)
+        if buf is None or len(buf) < size:
+            buf = array.array('B', bytes(-(-size//RX_PACKET_SIZE)*RX_PACKET_SIZE))
+            self._rx_bufs[cmd] = buf
+        return buf
+
+    def _read_length_prefixed(self, cmd, timing: dict, t_sent: float) -> memoryview:
+        '''
+        reads response into the preallocated buffer of cmd; once the size of the response is known from
+        the previous call of cmd, the response is read straight into the buffer without any copy
+
+        Returns
+        -------
+        zero-copy view on the response (including the length field) valid until cmd is sent again
+        '''
+        buf = self._rx_bufs.get(cmd, self._rx_chunk)
+        # address taken from results of print(dev):   ENDPOINT 0x81: Bulk IN
+        received = self._dev.read(0x81,buf,3000)
+        timing['first_byte'] = time.perf_counter() - t_sent
+        expected_data_len=int.from_bytes(memoryview(buf)[:4], 'little', signed=False)
+        if buf is self._rx_chunk or len(buf) < 4+expected_data_len:
+            first = memoryview(buf)[:received]
+            buf = self._rx_buffer(cmd, 4+expected_data_len)
+            memoryview(buf)[:min(received, len(buf))] = first[:len(buf)]
+        mv = memoryview(buf)
+        chunk = memoryview(self._rx_chunk)
         try:
-            while len(result)-4 < expected_data_len:
-                result.extend(self._dev.read(0x81,2000000,3000))
+            while received-4 < expected_data_len:
+                n = self._dev.read(0x81,self._rx_chunk,3000)
+                fits = max(0, min(n, len(mv)-received))
+                mv[received:received+fits] = chunk[:fits]
+                received += n
         except usb.core.USBTimeoutError as err:
             print(err)
-        if len(result)-4 != expected_data_len:
-            print(f'ERROR: received {len(result)-4}, expected {expected_data_len}; flushing Bulk IN')
+        timing['full_read'] = time.perf_counter() - t_sent
+        timing['bytes'] = received
+        if received-4 != expected_data_len:
+            timing['mismatch'] = True
+            print(f'ERROR: received {received-4}, expected {expected_data_len}; flushing Bulk IN')
             print(f'flushed {len(self._flush_Bulk_IN())}')
-            raise Exception(f"data lengths mismatch: expected {expected_data_len} received {len(result)-4}")
-        return result
+            self._in_dirty = False
+            self._notify_timing(cmd, timing)
+            raise Exception(f"data lengths mismatch: expected {expected_data_len} received {received-4}")
+        return mv[:received]
+
+    def _notify_timing(self, cmd, timing: dict):
+        if self.on_timing:
+            self.on_timing(cmd, timing)
 
     def _query_begins_with_4B_msg_length(self, request: str):
         '''
@@ -86,19 +215,24 @@ class OwonPDS6062T:
         cmd : str
             command to be executed by the oscilloscope
         '''
+        if (type(cmd) is str and cmd[-1] == '?') or (type(cmd) is bytes and cmd[-1] == b'?'[0]):
+            # response is left unread in Bulk IN
+            self._in_dirty = True
         self._dev.write(3,cmd)
     
     def get_id(self, ):
         return self.query('*IDN?')
 
     @classmethod
-    def raw_sample_buffer_to_ints(cls, rawsamples: array.array):
+    def raw_sample_buffer_to_ints(cls, rawsamples: array.array) -> np.ndarray:
         '''
         rawsamples as returned by ':DATA:WAVE:SCREen:CHx' without the length header
+
+        returns zero-copy int8 view on rawsamples (keep rawsamples unmodified while the view is in use)
         '''
         # data are 8 bit only contrary to the docs that states 12 bit - take only every other byte from the rawsamples
-        # convert unsigned 8-bit int to signed one
-        return map(lambda x: int.from_bytes([x], signed=True), rawsamples[1::2])
+        # reinterpret unsigned 8-bit int as signed one
+        return np.frombuffer(rawsamples, dtype=np.int8)[1::2]
     
     def get_data(self, ch: int):
         '''
@@ -113,17 +247,65 @@ class OwonPDS6062T:
 
         Returns
         -------
-        array[float] signed int data in bit range OwonPDS6062T.sample_bits
+        np.ndarray[int8] signed int data in bit range OwonPDS6062T.sample_bits
+        (zero-copy view on the receive buffer valid until get_data() for the same channel is called again)
         '''
         try:
             rawdata = self._send(':DATA:WAVE:SCREen:CH{}?'.format(ch))
         except Exception as ex:
             print(f"get_data: {ex}; retrying ...")
             rawdata = self._send(':DATA:WAVE:SCREen:CH{}?'.format(ch))
-        data = []
-
-        return self.raw_sample_buffer_to_ints(rawdata[4:])
+        return self.raw_sample_buffer_to_ints(memoryview(rawdata)[4:])
     
+    @staticmethod
+    def split_length_prefixed(rawdata) -> list:
+        '''
+        split buffer of consecutive length prefixed frames into zero-copy views on their bodies
+
+        frame:
+        [ length | 4B 'little endian' ]
+        [ body   | size defined by length field ]
+        '''
+        mv = memoryview(rawdata)
+        bodies = []
+        while len(mv) >= 4:
+            body_len = int.from_bytes(mv[:4], 'little', signed=False)
+            if len(mv)-4 < body_len:
+                raise Exception(f"truncated frame: expected {body_len} received {len(mv)-4}")
+            bodies.append(mv[4:4+body_len])
+            mv = mv[4+body_len:]
+        return bodies
+
+    @classmethod
+    def parse_depmem_all(cls, rawdata) -> tuple:
+        '''
+        rawdata as returned by ':DATA:WAVE:DEPMem:All?' including the outer length header
+
+        Returns
+        -------
+        (header bytes, {channel: raw samples}) as zero-copy views; raw samples are encoded the same
+        way as ':DATA:WAVE:SCREen:CHx?' data (cf. raw_sample_buffer_to_ints()), channels without data are omitted
+        '''
+        header, *channels = cls.split_length_prefixed(memoryview(rawdata)[4:])
+        return header, {ch: data for ch, data in enumerate(channels, 1) if len(data)}
+
+    def get_depmem_all(self, ):
+        '''
+        header and samples of all channels from the deep memory within single USB transaction
+        note the memory seems to be cleared by the readout
+
+        Returns
+        -------
+        (json header, {channel: raw samples}) cf. parse_depmem_all(); samples are valid until get_depmem_all() is called again
+        '''
+        try:
+            rawdata = self._send(':DATA:WAVE:DEPMem:All?')
+        except Exception as ex:
+            print(f"get_depmem_all: {ex}; retrying ...")
+            rawdata = self._send(':DATA:WAVE:DEPMem:All?')
+        header, channels = self.parse_depmem_all(rawdata)
+        return json.loads(header.tobytes().decode('utf-8')), channels
+
     def get_bmp(self, file_name = None):
         '''
         note this call can take quite some time to complete (~3s)
@@ -135,7 +317,7 @@ class OwonPDS6062T:
 
         Returns
         -------
-        raw binary bitmap data
+        raw binary bitmap data (zero-copy view on the receive buffer valid until get_bmp() is called again)
         '''
         try:
             rawdata = self._send(':DATA:WAVE:SCREen:BMP?')
@@ -0,0 +1,164 @@
+'''
+asyncio client of the oscilloscope relay (cf. relay_srv.py)
+
+Example of usage:
+    import asyncio
+    from relay_client import RelayClient, merge
+
+    async def main():
+        async with RelayClient('bench1') as c1, RelayClient('bench2') as c2:
+            async for client, msg in merge([c1, c2]):
+                print(client.url, msg[0], len(msg))
+    asyncio.run(main())
+'''
+import os
+import sys
+import random
+import asyncio
+
+from typing import AsyncIterator
+
+from tornado.websocket import websocket_connect
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from relay_srv import WS_TYPES, WS_FORMATS, WS_ENCODINGS, DEFAULT_PORT, FrameDecoder, decode_frame_msg, encode_frame_msg
+
+DEFAULT_BUFFER_SIZE=16 # messages
+RECONNECT_DELAY_MIN=0.5 # s
+RECONNECT_DELAY_MAX=30.0 # s
+
+def parse_target(target: str, default_port: int = DEFAULT_PORT) -> tuple:
+    '''
+    'host[:port]' -> (host, port)
+    '''
+    host, _, port = target.partition(':')
+    return host, int(port) if port else default_port
+
+class RelayClient:
+    '''
+    receives updates of single relay in the background; messages are passed decoded to raw (cf. FrameDecoder.decode_to_raw())
+
+    connection is re-established with exponential backoff whenever it fails; up to buffer_size messages not consumed yet are
+    buffered, the oldest are dropped beyond that (header of a dropped FRAME is carried over to the following one)
+    '''
+    def __init__(self, host: str, port: int = DEFAULT_PORT, encoding: WS_ENCODINGS = WS_ENCODINGS.RAW, fmt: WS_FORMATS = WS_FORMATS.FRAME,
+            backlog: int = 0, buffer_size: int = DEFAULT_BUFFER_SIZE, device: str = None):
+        '''
+        backlog - number of past frames requested on (each) connection, cf. '--history' of relay_srv.py
+        device - id of the oscilloscope when the relay serves several (cf. '/devices' of relay_srv.py)
+        '''
+        self.url = f'ws://{host}:{port}/updates_ws' + (f'/{device}' if device else '') + f'?format={fmt.value}&encoding={encoding.value}' + (f'&backlog={backlog}' if backlog else '')
+        self.received = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self._messages = asyncio.Queue(maxsize=max(1, buffer_size))
+        self._pending_header = None
+        self._conn = None
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        '''
+        iteration ends once the buffered messages are consumed
+        '''
+        self._closed = True
+        if self._conn:
+            self._conn.close()
+        if self._task:
+            self._task.cancel()
+        self._put(None)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    async def _run(self):
+        delay = RECONNECT_DELAY_MIN
+        while not self._closed:
+            print(f"connecting to oscilloscope relay on '{self.url}'")
+            try:
+                self._conn = await websocket_connect(self.url)
+                delay = RECONNECT_DELAY_MIN
+                decoder = FrameDecoder() # reference of delta encoding is valid within single connection only
+                while not self._closed:
+                    msg = await self._conn.read_message()
+                    if msg is None:
+                        break
+                    self.received += 1
+                    self._put(decoder.decode_to_raw(msg))
+            except asyncio.CancelledError:
+                break
+            except Exception as err:
+                print(f"relay '{self.url}' failed: {err}")
+            if self._closed:
+                break
+            self.reconnects += 1
+            print(f"relay '{self.url}' disconnected ... reconnecting in {delay:.1f} s")
+            await asyncio.sleep(delay*random.uniform(1, 1.1))
+            delay = min(delay*2, RECONNECT_DELAY_MAX)
+
+    def _put(self, msg):
+        while self._messages.full():
+            dropped = self._messages.get_nowait()
+            if dropped is None:
+                continue
+            self.dropped += 1
+            if dropped[0] == WS_TYPES.FRAME.value:
+                header = decode_frame_msg(dropped)['header']
+                if header is not None:
+                    self._pending_header = bytes(header)
+        self._messages.put_nowait(msg)
+
+    async def get(self, timeout: float = None):
+        '''
+        next message; None when the client is closed (or timeout expired)
+        '''
+        try:
+            msg = await asyncio.wait_for(self._messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if msg is None:
+            # keep the end visible to other consumers
+            self._put(None)
+            return None
+        if msg[0] == WS_TYPES.FRAME.value and self._pending_header is not None:
+            frame = decode_frame_msg(msg)
+            if frame['header'] is None:
+                msg = encode_frame_msg(frame['seq'], frame['t_start'], frame['t_end'], frame['header_id'], self._pending_header, frame['channels'])
+            self._pending_header = None
+        return msg
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+async def merge(clients: list) -> AsyncIterator[tuple]:
+    '''
+    yields (client, message) of several clients in the order of arrival until all of them are closed
+    '''
+    pending = {asyncio.ensure_future(c.get()): c for c in clients}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                client = pending.pop(task)
+                msg = task.result()
+                if msg is None:
+                    continue
+                pending[asyncio.ensure_future(client.get())] = client
+                yield client, msg
+    finally:
+        for task in pending:
+            task.cancel()
@@ -5,159 +5,832 @@ import argparse
 import asyncio
 import tornado, tornado.websocket
 import signal
+import time
+import re
+import zlib
+import base64
+import struct
+import collections
 from enum import Enum
 import json
 
+from typing import Callable
+
+import numpy as np
 import usb.core
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from acquisition import AcquisitionWorker, Frame, ACQ_MODES, CMD_PRIORITIES, DEFAULT_HEADER_POLL_INTERVAL, DEFAULT_MAX_POLL_INTERVAL, DEFAULT_KEEPALIVE_INTERVAL
 from owonPDS6062T import OwonPDS6062T
+from metrics import DeviceMetrics, FrameTrace, FPS_WINDOW, format_metrics
 
 DEFAULT_PORT=7997
+DEFAULT_QUEUE_SIZE=4
+DEFAULT_KEYFRAME_INTERVAL=30
+MEASUREMENTS_MAX_AGE=1.0 # s ... older frame is acquired anew for '/measurements'
+DEFAULT_HISTORY_SIZE=0 # frames
+# (regular expression, seconds) ... TTL of the first pattern matching /query request, responses are not cached with 0 TTL
+DEFAULT_QUERY_TTLS=(
+    (r'\*IDN\?', float('inf')),
+    (r':DATA:WAVE:.*', 0.0), # live data
+    (r':MEAS.*', 0.2),
+    (r'.*', 1.0), # settings ... changed via /write flush the cache, buttons of the oscilloscope are detected by the header poll
+)
+QUERY_CACHE_SIZE=1024 # entries
 
 class WS_TYPES(Enum):
     HEAD = 0
     CH1_DATA = 1
     CH2_DATA = 2
+    FRAME = 3 # header (when changed) and all displayed channels of single acquisition, cf. encode_frame_msg()
+    MEASUREMENTS = 4 # measurements of the displayed channels of single acquisition, cf. encode_measurements_msg()
 
-class RelayServer(tornado.web.Application):
-    def __init__(self, osci_instance_getter):
-        handlers=[
-            (r'/updates_ws', OsciUpdatesWebsocket, {'osci_instance_getter': osci_instance_getter}),
-            (r'/query', RestApi, {'osci_instance_getter': osci_instance_getter}),
-            (r'/write', RestApi, {'osci_instance_getter': osci_instance_getter}),
-        ]
-        super().__init__(handlers)
+class WS_FORMATS(Enum):
+    FRAME = 'frame' # single FRAME message per frame
+    LEGACY = 'legacy' # separate HEAD (when changed), CH1_DATA and CH2_DATA messages per frame
+    MEASUREMENTS = 'measurements' # only MEASUREMENTS message per frame
 
-class OsciUpdatesWebsocket(tornado.websocket.WebSocketHandler):
-    clients = set()
-    new_cli = False
-    osci_instance_getter=None
-    o=None
-
-    @classmethod
-    def enum_osci(cls):
-        osci = cls.osci_instance_getter()
-        if cls.o != osci:
-            cls.o = osci
-
-    def initialize(self, osci_instance_getter):
-        if OsciUpdatesWebsocket.osci_instance_getter != osci_instance_getter:
-            OsciUpdatesWebsocket.osci_instance_getter = osci_instance_getter
-            OsciUpdatesWebsocket.enum_osci()
-
-    async def open(self):
-        print(f"> opened WS connection from {self.request.connection.context.address} to {self.request.host}")
-        OsciUpdatesWebsocket.clients.add(self)
-        await asyncio.sleep(0)
-        OsciUpdatesWebsocket.new_cli = True # go through Queue instead to account for each new client?
+class WS_ENCODINGS(Enum):
+    # negotiated per client, applies to channels within FRAME messages
+    RAW = 'raw'
+    ZLIB = 'zlib'
+    DELTA = 'delta' # XOR against the channel of the previously sent frame compressed by zlib, periodic zlib keyframes
 
-    def on_message(self, message):
-        print(f"> WS msg from {self.request.connection.context.address}: {message}")
+class CH_ENCODINGS(Enum):
+    # encoding of single channel within FRAME message (upper 4 bits of the channel number byte)
+    RAW = 0
+    ZLIB = 1
+    XOR_ZLIB = 2 # XOR against the same channel of the previous frame received by the client
 
-    def on_close(self):
-        print(f"> closed WS connection from {self.request.connection.context.address} to {self.request.host}")
-        OsciUpdatesWebsocket.clients.remove(self)
-        if not OsciUpdatesWebsocket.clients:
-            print('> waiting for WS clients')
-
-    @classmethod
-    async def broadcast_screen_updates(cls, should_exit):
-        print('> waiting for WS clients')
-        last_header = ""
+# FRAME message fields: sequence number, acquisition start and end (unix time), header id, flags, number of channels
+FRAME_FIELDS = struct.Struct('<QddIBB')
+FRAME_FLAG_HEAD = 0x01
+
+def encode_frame_msg(seq: int, t_start: float, t_end: float, header_id: int, header: bytes, channels: dict, encodings: dict = None) -> bytes:
+    '''
+    [ type     | 1B WS_TYPES.FRAME ]
+    [ length   | 4B 'little endian' ]
+    [ fields   | FRAME_FIELDS ]
+    [ header   | HEAD response (4B length + json), present only with FRAME_FLAG_HEAD ]
+    [ channels | per channel: 1B channel number | CH_ENCODINGS << 4, 4B 'little endian' length, (encoded) 8-bit samples ]
+
+    encodings - {channel: CH_ENCODINGS} of channels not sent raw
+    '''
+    encodings = encodings if encodings else {}
+    parts = [FRAME_FIELDS.pack(seq, t_start, t_end, header_id, FRAME_FLAG_HEAD if header else 0, len(channels))]
+    if header:
+        parts.append(header)
+    for ch, samples in channels.items():
+        parts.extend([bytes([ch | encodings.get(ch, CH_ENCODINGS.RAW).value << 4]), len(samples).to_bytes(4, 'little'), samples])
+    return b''.join([bytes([WS_TYPES.FRAME.value]), sum(map(len, parts)).to_bytes(4, 'little'), *parts])
+
+def decode_frame_msg(msg) -> dict:
+    '''
+    inverse of encode_frame_msg(); header (including its 4B length, None when not present) and channels are zero-copy views on msg,
+    channels are left encoded as stated by encodings (cf. FrameDecoder)
+    '''
+    mv = memoryview(msg)[5:]
+    seq, t_start, t_end, header_id, flags, channels_count = FRAME_FIELDS.unpack_from(mv)
+    off = FRAME_FIELDS.size
+    header = None
+    if flags & FRAME_FLAG_HEAD:
+        header_len = int.from_bytes(mv[off:off+4], 'little', signed=False)
+        header = mv[off:off+4+header_len]
+        off += 4+header_len
+    channels = {}
+    encodings = {}
+    for _ in range(channels_count):
+        ch_len = int.from_bytes(mv[off+1:off+5], 'little', signed=False)
+        channels[mv[off] & 0x0f] = mv[off+5:off+5+ch_len]
+        encodings[mv[off] & 0x0f] = CH_ENCODINGS(mv[off] >> 4)
+        off += 5+ch_len
+    return {'seq': seq, 't_start': t_start, 't_end': t_end, 'header_id': header_id, 'header': header, 'channels': channels, 'encodings': encodings}
+
+class FrameDecoder:
+    '''
+    decodes channels of FRAME messages of single stream; keeps the previous samples as reference of XOR_ZLIB channels
+    '''
+    def __init__(self):
+        self.reference = {}
+
+    def decode(self, msg) -> dict:
+        '''
+        as decode_frame_msg() but with raw channels
+        '''
+        return self.decode_channels(decode_frame_msg(msg))
+
+    def decode_channels(self, frame: dict) -> dict:
+        for ch, data in frame['channels'].items():
+            encoding = frame['encodings'][ch]
+            if encoding == CH_ENCODINGS.ZLIB:
+                data = zlib.decompress(data)
+            elif encoding == CH_ENCODINGS.XOR_ZLIB:
+                ref = self.reference.get(ch)
+                delta = zlib.decompress(data)
+                if ref is None or len(ref) != len(delta):
+                    raise Exception(f"missing reference to decode delta of channel {ch} in frame {frame['seq']}")
+                data = np.bitwise_xor(np.frombuffer(delta, dtype=np.uint8), np.frombuffer(ref, dtype=np.uint8)).tobytes()
+            frame['channels'][ch] = data
+            frame['encodings'][ch] = CH_ENCODINGS.RAW
+            self.reference[ch] = data
+        return frame
+
+    def decode_to_raw(self, msg):
+        '''
+        FRAME message with all channels raw (msg itself when it is raw already), other messages are passed through
+        '''
+        if msg[0] != WS_TYPES.FRAME.value:
+            return msg
+        frame = decode_frame_msg(msg)
+        raw = all(e == CH_ENCODINGS.RAW for e in frame['encodings'].values())
+        self.decode_channels(frame)
+        if raw:
+            return msg
+        return encode_frame_msg(frame['seq'], frame['t_start'], frame['t_end'], frame['header_id'], frame['header'], frame['channels'])
+
+def measurements_obj(frame: Frame) -> dict:
+    return {'seq': frame.seq, 't_start': frame.t_start, 't_end': frame.t_end, 'header_id': frame.header_id, 'channels': {str(ch): m for ch, m in frame.measurements.items()}}
+
+def encode_measurements_msg(frame: Frame) -> bytes:
+    '''
+    [ type         | 1B WS_TYPES.MEASUREMENTS ]
+    [ length       | 4B 'little endian' ]
+    [ measurements | utf-8 json: seq, t_start, t_end, header_id, channels: {channel: measurements.measure()} ]
+    '''
+    body = json.dumps(measurements_obj(frame)).encode('utf-8')
+    return bytes([WS_TYPES.MEASUREMENTS.value])+len(body).to_bytes(4, 'little')+body
+
+def decode_measurements_msg(msg) -> dict:
+    '''
+    inverse of encode_measurements_msg() with int channel numbers
+    '''
+    obj = json.loads(bytes(memoryview(msg)[5:]).decode('utf-8'))
+    obj['channels'] = {int(ch): m for ch, m in obj['channels'].items()}
+    return obj
+
+def encode_channels(frame: Frame, encoding: WS_ENCODINGS, ref: Frame = None) -> tuple:
+    '''
+    returns ({channel: encoded samples}, {channel: CH_ENCODINGS}); ref is the frame last sent to the client (None for keyframe)
+    '''
+    if encoding == WS_ENCODINGS.RAW:
+        return frame.channels, {}
+    channels = {}
+    encodings = {}
+    for ch, samples in frame.channels.items():
+        ref_samples = ref.channels.get(ch) if ref and encoding == WS_ENCODINGS.DELTA else None
+        if ref_samples is not None and len(ref_samples) == len(samples):
+            delta = np.bitwise_xor(np.frombuffer(samples, dtype=np.uint8), np.frombuffer(ref_samples, dtype=np.uint8))
+            channels[ch] = zlib.compress(delta.data)
+            encodings[ch] = CH_ENCODINGS.XOR_ZLIB
+        else:
+            channels[ch] = zlib.compress(samples)
+            encodings[ch] = CH_ENCODINGS.ZLIB
+    return channels, encodings
+
+def encode_frame(frame: Frame, fmt: WS_FORMATS, with_header: bool, encoding: WS_ENCODINGS = WS_ENCODINGS.RAW, ref: Frame = None) -> list:
+    '''
+    messages of frame in given format; each variant is encoded once and shared by all the clients
+    (clients in sync share also the delta encoded variants)
+    '''
+    if fmt == WS_FORMATS.MEASUREMENTS:
+        with_header, encoding = False, WS_ENCODINGS.RAW
+    if fmt != WS_FORMATS.FRAME or encoding != WS_ENCODINGS.DELTA:
+        ref = None
+    key = (fmt, with_header, encoding, ref.seq if ref else None)
+    msgs = frame.encoded.get(key)
+    if msgs is None:
+        if fmt == WS_FORMATS.FRAME:
+            channels, encodings = encode_channels(frame, encoding, ref)
+            msgs = [encode_frame_msg(frame.seq, frame.t_start, frame.t_end, frame.header_id, frame.header if with_header else None, channels, encodings)]
+        elif fmt == WS_FORMATS.MEASUREMENTS:
+            msgs = [encode_measurements_msg(frame)]
+        else:
+            msgs = [bytes([WS_TYPES.HEAD.value])+frame.header] if with_header else []
+            msgs.extend(bytes([WS_TYPES(ch).value])+len(samples).to_bytes(4, 'little')+samples for ch, samples in frame.channels.items())
+        frame.encoded[key] = msgs
+    return msgs
+
+def encode_frames(frames: list) -> bytes:
+    '''
+    concatenated FRAME messages of raw frames; header is present in the first one and whenever it changes
+    '''
+    msgs = []
+    header_id = None
+    for frame in frames:
+        msgs.append(encode_frame_msg(frame.seq, frame.t_start, frame.t_end, frame.header_id, frame.header if frame.header_id != header_id else None, frame.channels))
+        header_id = frame.header_id
+    return b''.join(msgs)
+
+class FrameHistory:
+    '''
+    last size frames (with their headers and timestamps) in a fixed array of slots; seq and t_start of the slots are
+    kept in numpy arrays so that ranges are looked up without walking the frames
+    '''
+    def __init__(self, size: int = DEFAULT_HISTORY_SIZE):
+        self.size = max(0, size)
+        self.slots = [None]*self.size
+        self.seqs = np.full(self.size, -1, dtype=np.int64)
+        self.t_starts = np.full(self.size, np.nan)
+        self.count = 0 # frames pushed in total
+
+    def push(self, frame: Frame):
+        if not self.size:
+            return
+        i = self.count % self.size
+        # own instance without the cache of encoded messages, which would be kept alive along with the frame
+        self.slots[i] = Frame(frame.seq, frame.header, frame.header_id, frame.header_changed, frame.channels, frame.t_start, frame.t_end, frame.decoded_header)
+        self.seqs[i] = frame.seq
+        self.t_starts[i] = frame.t_start
+        self.count += 1
+
+    def last(self, count: int) -> list:
+        '''
+        up to count newest frames, the oldest first
+        '''
+        count = max(0, min(count, self.size, self.count))
+        return [self.slots[(self.count-count+i) % self.size] for i in range(count)]
+
+    def range(self, from_seq: int = None, to_seq: int = None, since: float = None, until: float = None) -> list:
+        '''
+        frames within the inclusive bounds (those not set are not applied), the oldest first
+        '''
+        mask = self.seqs >= 0
+        if from_seq is not None:
+            mask &= self.seqs >= from_seq
+        if to_seq is not None:
+            mask &= self.seqs <= to_seq
+        if since is not None:
+            mask &= self.t_starts >= since
+        if until is not None:
+            mask &= self.t_starts <= until
+        idx = np.flatnonzero(mask)
+        return [self.slots[i] for i in idx[np.argsort(self.seqs[idx])]]
+
+class SEND_POLICIES(Enum):
+    DROP_OLDEST = 'drop-oldest' # full queue drops the oldest pending frame
+    LATEST_ONLY = 'latest-only' # only the newest frame is kept pending
+    BLOCK = 'block' # acquisition waits until the slowest client has space in its queue
+
+class ClientSendQueue:
+    '''
+    bounded queue of frames pending to be sent to single client
+
+    header of a dropped frame is carried over to the following frame so that the client never misses header change;
+    header is sent also with the first frame and whenever it differs from the last frame sent to the client (regardless of
+    the frames the client joined in between of);
+    backlog of past frames (cf. put_backlog()) is sent before the queued frames and is never dropped
+    '''
+    def __init__(self, write_message: Callable, maxsize: int = DEFAULT_QUEUE_SIZE, policy: SEND_POLICIES = SEND_POLICIES.DROP_OLDEST, fmt: WS_FORMATS = WS_FORMATS.FRAME,
+            encoding: WS_ENCODINGS = WS_ENCODINGS.RAW, keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL):
+        self.write_message = write_message
+        self.maxsize = 1 if policy == SEND_POLICIES.LATEST_ONLY else max(1, maxsize)
+        self.policy = policy
+        self.fmt = fmt
+        self.encoding = encoding
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.last_sent = None # reference of DELTA encoding
+        self.since_keyframe = 0
+        self.bytes_sent = 0
+        self.frames = collections.deque() # [enqueue timestamp, frame, with header]
+        self.backlog = collections.deque() # as frames
+        self.sent = 0
+        self.dropped = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_sum = 0.0
+        self._closed = False
+        self._has_frames = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._send_loop())
+
+    def stop(self):
+        self._closed = True
+        self._has_frames.set()
+        self._has_space.set()
+
+    def put(self, frame: Frame):
+        if self._closed:
+            return
+        entry = [time.monotonic(), frame, frame.header_changed]
+        while len(self.frames) >= self.maxsize and self.policy != SEND_POLICIES.BLOCK:
+            _, _, with_header = self.frames.popleft()
+            self.dropped += 1
+            if with_header:
+                (self.frames[0] if self.frames else entry)[2] = True
+        self.frames.append(entry)
+        self._has_frames.set()
+
+    def put_backlog(self, frames: list):
+        '''
+        frames - past frames, the oldest first
+        '''
+        now = time.monotonic()
+        self.backlog.extend([now, frame, i == 0 or frame.header_id != frames[i-1].header_id] for i, frame in enumerate(frames))
+        if self.backlog:
+            self._has_frames.set()
+
+    async def wait_for_space(self):
+        '''
+        returns immediately unless the policy is BLOCK
+        '''
+        while self.policy == SEND_POLICIES.BLOCK and len(self.frames) >= self.maxsize and not self._closed:
+            self._has_space.clear()
+            await self._has_space.wait()
+
+    async def _send_loop(self):
+        while not self._closed:
+            if not self.frames and not self.backlog:
+                self._has_frames.clear()
+                await self._has_frames.wait()
+                continue
+            if self.backlog:
+                ts, frame, with_header = self.backlog.popleft()
+            else:
+                ts, frame, with_header = self.frames.popleft()
+                self._has_space.set()
+            if self.last_sent is None or self.last_sent.header_id != frame.header_id:
+                with_header = True
+            keyframe = self.last_sent is None or self.since_keyframe >= self.keyframe_interval-1
+            self.since_keyframe = 0 if keyframe else self.since_keyframe+1
+            try:
+                for msg in encode_frame(frame, self.fmt, with_header, self.encoding, None if keyframe else self.last_sent):
+                    self.bytes_sent += len(msg)
+                    await self.write_message(msg)
+            except tornado.websocket.WebSocketClosedError:
+                self.stop()
+                break
+            except Exception as err:
+                print(f"> sending to WS client failed: {err}")
+                self.stop()
+                break
+            self.sent += 1
+            self.last_sent = frame
+            self.lag_last = time.monotonic() - ts
+            self.lag_max = max(self.lag_max, self.lag_last)
+            self.lag_sum += self.lag_last
+
+    def depth(self) -> int:
+        '''
+        frames pending to be sent, the history backlog included
+        '''
+        return len(self.frames)+len(self.backlog)
+
+    def stats(self) -> dict:
+        '''
+        lag is the time between the frame being enqueued and fully written to the client
+        '''
+        return {
+            'queue_depth': self.depth(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'bytes_sent': self.bytes_sent,
+            'encoding': self.encoding.value,
+            'lag_last_ms': self.lag_last*1000,
+            'lag_mean_ms': self.lag_sum/self.sent*1000 if self.sent else 0.0,
+            'lag_max_ms': self.lag_max*1000,
+        }
+
+class QueryCache:
+    '''
+    responses of /query requests kept for TTL given by pattern of the query; concurrent identical queries are
+    coalesced into single USB transaction
+    '''
+    def __init__(self, ttls: list = DEFAULT_QUERY_TTLS):
+        '''
+        ttls - [(regular expression, seconds)], the first pattern fully matching the query applies (case-insensitive)
+        '''
+        self.ttls = [(re.compile(pattern, re.IGNORECASE), ttl) for pattern, ttl in ttls]
+        self.entries = {} # {query: (expiration, response)}
+        self.pending = {} # {query: future of response being fetched}
+        self.generation = 0 # incremented by flush()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.flushes = 0
+
+    def ttl(self, query: str) -> float:
+        for pattern, ttl in self.ttls:
+            if pattern.fullmatch(query):
+                return ttl
+        return 0.0
+
+    def flush(self):
+        '''
+        settings may have changed ... responses fetched in the meantime are not cached either
+        '''
+        self.entries.clear()
+        self.pending.clear()
+        self.generation += 1
+        self.flushes += 1
+
+    async def get(self, query: bytes, fetch: Callable) -> bytes:
+        '''
+        fetch - coroutine function returning response of the query when not cached
+        '''
+        key = query.decode('utf-8', 'replace').strip().upper()
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        fut = self.pending.get(key)
+        if fut:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+        generation = self.generation
+        fut = asyncio.ensure_future(fetch())
+        self.pending[key] = fut
+        try:
+            response = await asyncio.shield(fut)
+        finally:
+            if self.pending.get(key) is fut:
+                del self.pending[key]
+        ttl = self.ttl(key)
+        if ttl > 0 and generation == self.generation:
+            if len(self.entries) >= QUERY_CACHE_SIZE:
+                now = time.monotonic()
+                self.entries = {k: e for k, e in self.entries.items() if e[0] > now}
+            if len(self.entries) < QUERY_CACHE_SIZE:
+                self.entries[key] = (time.monotonic() + ttl, response)
+        return response
+
+class DeviceRelay:
+    '''
+    acquisition worker, WS clients and history of single oscilloscope
+    '''
+    def __init__(self, device_id: str, worker: AcquisitionWorker, queue_size: int = DEFAULT_QUEUE_SIZE, send_policy: SEND_POLICIES = SEND_POLICIES.DROP_OLDEST,
+            history_size: int = DEFAULT_HISTORY_SIZE, trace: FrameTrace = None, query_ttls: list = DEFAULT_QUERY_TTLS):
+        '''
+        trace - optional log of each frame's timing
+        query_ttls - cf. QueryCache
+        '''
+        self.id = device_id
+        self.worker = worker
+        self.queue_size = queue_size
+        self.send_policy = send_policy
+        self.clients = set()
+        self.history = FrameHistory(history_size)
+        self.metrics = DeviceMetrics()
+        self.worker.on_timing = self.metrics.on_timing
+        self.trace = trace
+        self.closed_bytes_sent = 0 # by the clients disconnected already
+        self.query_cache = QueryCache(query_ttls)
+        self._header_id = None
+
+    def info(self) -> dict:
+        dev = self.worker.o._dev if self.worker.o else None
+        return {
+            'id': self.id,
+            **self.worker.selector,
+            'connected': dev is not None,
+            'bus': dev.bus if dev else self.worker.selector['bus'],
+            'address': dev.address if dev else self.worker.selector['address'],
+            'acq_mode': self.worker.acq_mode.value,
+            'clients': len(self.clients),
+            'history': min(self.history.count, self.history.size),
+        }
+
+    async def broadcast_screen_updates(self, should_exit):
+        '''
+        fans out frames acquired by the worker thread to the clients
+        '''
+        print(f'> {self.id}: waiting for WS clients')
         while not should_exit():
-            clis=cls.clients.copy()
-            if not clis:
+            # history is recorded even when nobody watches
+            self.worker.active = bool(self.clients) or bool(self.history.size)
+            if not self.worker.active:
                 await asyncio.sleep(0.5)
                 continue
-            await asyncio.sleep(0)
             try:
-                header=cls.o._send(':DATA:WAVE:SCREen:HEAD?')
-                if last_header != header or cls.new_cli:
-                    for ws in clis:
-                        try:
-                            ws.write_message(bytes([WS_TYPES.HEAD.value])+header, binary = True)
-                        except tornado.websocket.WebSocketClosedError as err:
-                            pass
-                    last_header = header
-                    cls.decoded_header = json.loads(bytes(last_header[4:]).decode('utf-8').strip())
-                    cls.displayed_channels = { int(x['NAME'][-1]) : x['DISPLAY'] for x in cls.decoded_header['CHANNEL'] }
-                    cls.new_cli = False
-                for ch in range(1,3):
-                    if cls.displayed_channels[ch] == 'OFF':
-                        continue
-                    chan_data=cls.o._send(':DATA:WAVE:SCREen:CH{}?'.format(ch))
-                    rawdata = chan_data[4:][1::2] # 8-bit only ... strip away byte that is always 0 within each sample
-                    for ws in clis:
-                        try:
-                            ws.write_message(bytes([WS_TYPES(ch).value])+int(len(rawdata)).to_bytes(4, 'little')+rawdata, binary = True)
-                        except tornado.websocket.WebSocketClosedError as err:
-                            pass
-            except usb.core.USBError as err:
-                await asyncio.sleep(1)
-                cls.enum_osci()
-        for ws in cls.clients.copy():
+                frame = await asyncio.wait_for(self.worker.frames.get(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            if frame.header_id != self._header_id:
+                # settings were changed (e.g. by the buttons of the oscilloscope)
+                if self._header_id is not None:
+                    self.query_cache.flush()
+                self._header_id = frame.header_id
+            self.history.push(frame)
+            # no await since the push ... clients joined later get the frame within their backlog, the others here
+            clis=self.clients.copy()
+            self.metrics.on_frame(frame)
+            if self.trace:
+                self.trace.write(self.id, frame, len(clis))
+            for ws in clis:
+                await ws.send_queue.wait_for_space()
+                ws.send_queue.put(frame)
+        self.worker.active = False
+        for ws in self.clients.copy():
             ws.close()
 
-class RestApi(tornado.web.RequestHandler):
-    osci_instance_getter=None
+class DeviceHandlerMixin:
+    '''
+    request handlers addressing the oscilloscope by the optional last path segment (the first one of the relay when not present)
+    '''
+    def initialize(self, devices: dict):
+        self.devices = devices
+
+    def prepare(self):
+        device_id = self.path_args[0] if self.path_args else None
+        if device_id is None and self.devices:
+            device_id = next(iter(self.devices))
+        if device_id not in self.devices:
+            raise tornado.web.HTTPError(404, f'unknown device {device_id}')
+        self.device = self.devices[device_id]
+        self.worker = self.device.worker
+
+class OsciUpdatesWebsocket(DeviceHandlerMixin, tornado.websocket.WebSocketHandler):
+    async def open(self, device_id=None):
+        print(f"> opened WS connection from {self.request.connection.context.address} to {self.request.host}{self.request.path}")
+        try:
+            fmt = WS_FORMATS(self.get_argument('format', WS_FORMATS.FRAME.value))
+        except ValueError:
+            fmt = WS_FORMATS.FRAME
+        self.send_queue = ClientSendQueue(lambda msg: self.write_message(msg, binary = True), self.device.queue_size, self.device.send_policy, fmt)
+        try:
+            self.negotiate({k: self.get_argument(k) for k in ('encoding', 'keyframe') if self.get_argument(k, None)})
+            # late joining client may ask for the last frames to be sent immediately
+            self.send_queue.put_backlog(self.device.history.last(int(self.get_argument('backlog', 0))))
+        except ValueError as err:
+            print(f"> invalid WS arguments: {err}")
+        self.send_queue.start()
+        self.device.clients.add(self)
+
+    def on_message(self, message):
+        print(f"> WS msg from {self.request.connection.context.address}: {message}")
+        try:
+            self.negotiate(json.loads(message))
+        except (ValueError, TypeError) as err:
+            print(f"> invalid WS msg: {err}")
+
+    def negotiate(self, params: dict):
+        '''
+        params (from query arguments or a JSON message), e.g. {"encoding": "delta", "keyframe": 30}
+            encoding - channels encoding, cf. WS_ENCODINGS
+            keyframe - with delta encoding, every keyframe-th frame is sent without reference to the previous one
+        '''
+        if 'encoding' in params:
+            self.send_queue.encoding = WS_ENCODINGS(params['encoding'])
+            self.send_queue.last_sent = None # restart from keyframe
+        if 'keyframe' in params:
+            self.send_queue.keyframe_interval = max(1, int(params['keyframe']))
 
-    def initialize(self, osci_instance_getter):
-        self.osci_instance_getter = osci_instance_getter
+    def on_close(self):
+        print(f"> closed WS connection from {self.request.connection.context.address} to {self.request.host}{self.request.path}: {self.send_queue.stats()}")
+        self.send_queue.stop()
+        self.device.clients.discard(self)
+        self.device.closed_bytes_sent += self.send_queue.bytes_sent
+        if not self.device.clients:
+            print(f'> {self.device.id}: waiting for WS clients')
 
-    def post(self):
+class RestApi(DeviceHandlerMixin, tornado.web.RequestHandler):
+    async def post(self, device_id=None):
         #print(f"POST from {self.request.connection.context.address}: {self.request.body}")
-        if self.request.path == '/query':
-            if self.request.body[-1] != b'?'[0]:
+        body = self.request.body
+        if self.request.path.startswith('/query'):
+            if body[-1] != b'?'[0]:
                 self.set_status(400)
                 self.finish('{"error":"Query has to end with \'?\'. Did you mean to use \'/write\' path?"}')
                 return
-            self.write(bytes(self.osci_instance_getter()._send(self.request.body)))
+            # response is copied within the worker as its receive buffer is reused by the next read
+            self.write(await self.device.query_cache.get(body, lambda: self.worker.call(lambda o: bytes(o._send(body)), CMD_PRIORITIES.QUERY)))
             self.set_header('Content-Type', 'application/octet-stream')
-        elif self.request.path == '/write':
-            if self.request.body[-1] == b'?'[0]:
+        elif self.request.path.startswith('/write'):
+            if body[-1] == b'?'[0]:
                 self.set_status(400)
                 self.finish('{"error":"Write should not end with \'?\'. Did you mean to use \'/query\' path?"}')
                 return
-            self.osci_instance_getter().write(self.request.body)
+            self.device.query_cache.flush()
+            await self.worker.call(lambda o: o.write(body), CMD_PRIORITIES.WRITE)
+
+def run_batch(o: OwonPDS6062T, commands: list) -> list:
+    '''
+    executes commands in order (commands ending with '?' are queries), stops at the first failure
+
+    Returns
+    -------
+    [result] cf. BatchApi
+    '''
+    results = []
+    for cmd in commands:
+        try:
+            if cmd.endswith('?'):
+                # response is copied as the receive buffer is reused by the next read
+                response = bytes(o._send(cmd))
+                try:
+                    results.append({'response': response.decode('utf-8')})
+                except UnicodeDecodeError:
+                    results.append({'response_base64': base64.b64encode(response).decode('ascii')})
+            else:
+                o.write(cmd)
+                results.append({})
+        except usb.core.USBError:
+            raise
+        except Exception as err:
+            results.append({'error': str(err)})
+            break
+    return results
+
+class BatchApi(DeviceHandlerMixin, tornado.web.RequestHandler):
+    async def post(self, device_id=None):
+        '''
+        body - JSON list of commands executed in order without any other command or frame acquisition in between,
+            e.g. [":HORIzontal:SCALe 100us", ":CH1:SCALe 1V", ":CH1:SCALe?"]
+
+        returns JSON list of results in the order of commands: {} for write, {"response": str} for query
+        ({"response_base64": str} when the response is binary), {"error": str} of the failed command (the rest is not executed)
+        '''
+        try:
+            commands = json.loads(self.request.body)
+            if not isinstance(commands, list) or not all(isinstance(c, str) and c for c in commands):
+                raise ValueError('list of commands expected')
+        except ValueError as err:
+            self.set_status(400)
+            self.finish(json.dumps({'error': str(err)}))
+            return
+        writes = any(not c.endswith('?') for c in commands)
+        if writes:
+            self.device.query_cache.flush()
+        results = await self.worker.call(lambda o: run_batch(o, commands), CMD_PRIORITIES.WRITE if writes else CMD_PRIORITIES.QUERY)
+        if results and 'error' in results[-1]:
+            self.set_status(500)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(results))
+
+class HistoryApi(DeviceHandlerMixin, tornado.web.RequestHandler):
+    def get(self, device_id=None):
+        '''
+        frames of the history within optional bounds: from_seq, to_seq (sequence numbers), since, until (unix time);
+        returned as concatenated FRAME messages (cf. encode_frames())
+        '''
+        try:
+            bounds = {k: t(self.get_argument(k)) for k, t in (('from_seq', int), ('to_seq', int), ('since', float), ('until', float)) if self.get_argument(k, None)}
+        except ValueError as err:
+            self.set_status(400)
+            self.finish(json.dumps({'error': str(err)}))
+            return
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.finish(encode_frames(self.device.history.range(**bounds)))
+
+class MeasurementsApi(DeviceHandlerMixin, tornado.web.RequestHandler):
+    async def get(self, device_id=None):
+        frame = self.worker.last_frame
+        if frame is None or time.time() - frame.t_end > MEASUREMENTS_MAX_AGE:
+            # no WS client keeps the acquisition running
+            frame = await self.worker.call(lambda o: self.worker.read_frame(), CMD_PRIORITIES.QUERY)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(measurements_obj(frame)))
+
+class ClientsApi(tornado.web.RequestHandler):
+    def initialize(self, devices: dict):
+        self.devices = devices
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps([{'device': device.id, 'address': str(ws.request.connection.context.address), **ws.send_queue.stats()} for device in self.devices.values() for ws in device.clients]))
+
+class DevicesApi(tornado.web.RequestHandler):
+    def initialize(self, devices: dict):
+        self.devices = devices
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps([device.info() for device in self.devices.values()]))
+
+def metrics_text(devices: dict) -> str:
+    '''
+    metrics of all the devices in Prometheus text format
+    '''
+    devs = [({'device': d.id}, d) for d in devices.values()]
+    clients = [({'device': d.id, 'client': str(ws.request.connection.context.address)}, ws.send_queue) for d in devices.values() for ws in d.clients.copy()]
+    return format_metrics([
+        ('owon_usb_command_seconds', 'histogram', 'Duration of USB transaction per SCPI command.', [s for l, d in devs for s in d.metrics.command_samples(l)]),
+        ('owon_usb_stage_seconds_total', 'counter', 'Time spent in stages of USB transactions (flush, write, first_byte, full_read).',
+            [({**l, 'stage': stage}, v) for l, d in devs for stage, v in list(d.metrics.stages.items())]),
+        ('owon_usb_read_bytes_total', 'counter', 'Bytes read from the oscilloscope.', [(l, d.metrics.bytes_read) for l, d in devs]),
+        ('owon_usb_length_mismatches_total', 'counter', 'Responses not matching their length field.', [(l, d.metrics.mismatches) for l, d in devs]),
+        ('owon_frame_retries_total', 'counter', 'Frames whose acquisition failed and was retried.', [(l, d.worker.failed_frames) for l, d in devs]),
+        ('owon_reconnects_total', 'counter', 'Reconnections of the oscilloscope.', [(l, d.worker.reconnects) for l, d in devs]),
+        ('owon_connected', 'gauge', 'Oscilloscope is connected.', [(l, int(d.worker.o is not None)) for l, d in devs]),
+        ('owon_frames_total', 'counter', 'Frames acquired.', [(l, d.metrics.frames) for l, d in devs]),
+        ('owon_frames_skipped_total', 'counter', 'Frames not delivered as equal to the previous one.', [(l, d.worker.skipped_frames) for l, d in devs]),
+        ('owon_poll_interval_seconds', 'gauge', 'Interval between frame polls derived from the timebase.', [(l, d.worker.poll_interval()) for l, d in devs]),
+        ('owon_frames_per_second', 'gauge', f'Frames acquired per second over the last {FPS_WINDOW:g} s.', [(l, d.metrics.fps()) for l, d in devs]),
+        ('owon_frame_bytes_total', 'counter', 'Bytes of channels data of the frames acquired.', [(l, d.metrics.frame_bytes) for l, d in devs]),
+        ('owon_frame_acquisition_seconds', 'histogram', 'Duration of frame acquisition.', [(l, d.metrics.acquisition) for l, d in devs]),
+        ('owon_frame_delivery_seconds', 'histogram', 'Delay between the end of frame acquisition and its broadcast to the clients.', [(l, d.metrics.delivery) for l, d in devs]),
+        ('owon_query_cache_hits_total', 'counter', 'Queries answered by the cache.', [(l, d.query_cache.hits) for l, d in devs]),
+        ('owon_query_cache_misses_total', 'counter', 'Queries sent to the oscilloscope.', [(l, d.query_cache.misses) for l, d in devs]),
+        ('owon_query_cache_coalesced_total', 'counter', 'Queries answered by the transaction of identical concurrent query.', [(l, d.query_cache.coalesced) for l, d in devs]),
+        ('owon_query_cache_flushes_total', 'counter', 'Flushes of the cache by writes and settings changes.', [(l, d.query_cache.flushes) for l, d in devs]),
+        ('owon_clients', 'gauge', 'Connected WS clients.', [(l, len(d.clients)) for l, d in devs]),
+        ('owon_sent_bytes_total', 'counter', 'Bytes sent to the WS clients.',
+            [(l, d.closed_bytes_sent + sum(ws.send_queue.bytes_sent for ws in d.clients.copy())) for l, d in devs]),
+        ('owon_client_queue_depth', 'gauge', 'Frames pending to be sent to the client (history backlog included).', [(l, q.depth()) for l, q in clients]),
+        ('owon_client_dropped_frames_total', 'counter', 'Frames dropped by the client send queue.', [(l, q.dropped) for l, q in clients]),
+        ('owon_client_lag_seconds', 'gauge', 'Delay between queueing and sending of the last frame to the client.', [(l, q.lag_last) for l, q in clients]),
+    ])
+
+class MetricsApi(tornado.web.RequestHandler):
+    def initialize(self, devices: dict):
+        self.devices = devices
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics_text(self.devices))
+
+class RelayServer(tornado.web.Application):
+    def __init__(self, devices: dict):
+        '''
+        devices - {device id: DeviceRelay}; paths without device id address the first one
+        '''
+        dev = {'devices': devices}
+        handlers=[
+            (r'/updates_ws(?:/([^/]+))?', OsciUpdatesWebsocket, dev),
+            (r'/history(?:/([^/]+))?', HistoryApi, dev),
+            (r'/query(?:/([^/]+))?', RestApi, dev),
+            (r'/write(?:/([^/]+))?', RestApi, dev),
+            (r'/batch(?:/([^/]+))?', BatchApi, dev),
+            (r'/measurements(?:/([^/]+))?', MeasurementsApi, dev),
+            (r'/clients', ClientsApi, dev),
+            (r'/devices', DevicesApi, dev),
+            (r'/metrics', MetricsApi, dev),
+        ]
+        super().__init__(handlers)
+
+def parse_device_selector(selector: str) -> dict:
+    '''
+    'bus:address' or serial number -> keyword arguments of AcquisitionWorker
+    '''
+    bus, _, address = selector.partition(':')
+    if bus.isdigit() and address.isdigit():
+        return {'bus': int(bus), 'address': int(address)}
+    return {'serial': selector}
 
 class OsciRelayApp():
     exit_app = False
 
-    def __init__(self):
-        self.o = OwonPDS6062T()
+    def __init__(self, usb_find=None, selectors: list = None):
+        '''
+        selectors - oscilloscopes to be served (cf. parse_device_selector()), all the connected ones when not set
+        '''
+        self.workers = OsciRelayApp.create_workers(usb_find, selectors)
         signal.signal(signal.SIGINT, self._sig_exit)
         signal.signal(signal.SIGTERM, self._sig_exit)
 
+    @staticmethod
+    def create_workers(usb_find=None, selectors: list = None) -> dict:
+        '''
+        returns {device id: AcquisitionWorker}
+        '''
+        if not selectors:
+            selectors = []
+            for dev in OwonPDS6062T.find_all(usb_find):
+                serial = OwonPDS6062T.device_serial(dev)
+                # serial number survives reconnection of the device, address does not
+                selectors.append({'serial': serial} if serial else {'bus': dev.bus, 'address': dev.address})
+        workers = {}
+        for selector in selectors:
+            worker = AcquisitionWorker(usb_find, **selector)
+            workers[OwonPDS6062T.device_id(worker.o._dev)] = worker
+        if not workers:
+            raise ValueError('Device not found')
+        return workers
+
     def _sig_exit(self, signum, frame):
         self.exit_app = True
 
     def should_exit(self):
         return self.exit_app
 
-    def get_osci_instance(self):
-        return self.o
-
-    async def osci_reconnector(self):
-        while True:
-            await asyncio.sleep(1)
-            if not usb.core.find(idVendor=self.o._dev.idVendor, idProduct=self.o._dev.idProduct):
-                print('> waiting for oscilloscope to be reconnected')
-                while True:
-                    try:
-                        self.o = OwonPDS6062T()
-                        print('> oscilloscope reconnected')
-                        break
-                    except Exception:
-                        pass
-
-    async def start(self, port):
-        asyncio.create_task(self.osci_reconnector())
-
-        srv = RelayServer(self.get_osci_instance)
-        print(f'> listening on port {port}')
+    async def start(self, port, acq_mode=ACQ_MODES.SCREEN, queue_size=DEFAULT_QUEUE_SIZE, send_policy=SEND_POLICIES.DROP_OLDEST, header_poll_interval=DEFAULT_HEADER_POLL_INTERVAL,
+            history_size=DEFAULT_HISTORY_SIZE, trace_file: str = None, query_ttls: list = DEFAULT_QUERY_TTLS,
+            max_poll_interval=DEFAULT_MAX_POLL_INTERVAL, keepalive_interval=DEFAULT_KEEPALIVE_INTERVAL):
+        '''
+        trace_file - JSON line per frame is appended to when set (cf. metrics.FrameTrace)
+        query_ttls - cf. QueryCache
+        max_poll_interval, keepalive_interval - cf. AcquisitionWorker
+        '''
+        trace = FrameTrace(trace_file) if trace_file else None
+        devices = {}
+        for device_id, worker in self.workers.items():
+            worker.acq_mode = acq_mode
+            worker.header_poll_interval = header_poll_interval
+            worker.max_poll_interval = max_poll_interval
+            worker.keepalive_interval = keepalive_interval
+            worker.start(asyncio.get_running_loop())
+            devices[device_id] = DeviceRelay(device_id, worker, queue_size, send_policy, history_size, trace, query_ttls)
+        srv = RelayServer(devices)
+        print(f"> listening on port {port}, devices: {', '.join(devices)}")
         srv.listen(port)
 
-        await OsciUpdatesWebsocket.broadcast_screen_updates(self.should_exit)
+        await asyncio.gather(*(device.broadcast_screen_updates(self.should_exit) for device in devices.values()))
+        for worker in self.workers.values():
+            worker.stop()
+        if trace:
+            trace.close()
 
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Relay updates from oscilloscope and commands to it over network. Allows to have multiple clients connected to single osci.")
@@ -169,10 +842,94 @@ def build_parser() -> argparse.ArgumentParser:
         nargs='?',
         default=DEFAULT_PORT,
     )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        help="Acquisition mode: 'screen' reads HEAD, CH1 and CH2 separately; 'depmem' reads all at once via :DATA:WAVE:DEPMem:All? (faster, clears the deep memory on readout).",
+        type=str,
+        choices=[m.value for m in ACQ_MODES],
+        nargs='?',
+        default=ACQ_MODES.SCREEN.value,
+    )
+    parser.add_argument(
+        "-q",
+        "--queue-size",
+        help="Maximum number of frames pending to be sent to each websocket client.",
+        type=int,
+        nargs='?',
+        default=DEFAULT_QUEUE_SIZE,
+    )
+    parser.add_argument(
+        "-s",
+        "--send-policy",
+        help="What to do when client's queue is full: 'drop-oldest' frame, keep 'latest-only' frame or 'block' acquisition until the slowest client catches up.",
+        type=str,
+        choices=[p.value for p in SEND_POLICIES],
+        nargs='?',
+        default=SEND_POLICIES.DROP_OLDEST.value,
+    )
+    parser.add_argument(
+        "--header-poll",
+        help="Seconds between polls of the header in 'screen' mode to detect settings changed on the oscilloscope itself; settings changed via '/write' are detected immediately. 0 polls the header with every frame.",
+        type=float,
+        nargs='?',
+        default=DEFAULT_HEADER_POLL_INTERVAL,
+    )
+    parser.add_argument(
+        "--max-poll-interval",
+        help="Frames are polled once per screen sweep given by the timebase (e.g. every 1.52 s at 100ms/div), but at least every this many seconds. 0 polls as fast as possible.",
+        type=float,
+        nargs='?',
+        default=DEFAULT_MAX_POLL_INTERVAL,
+    )
+    parser.add_argument(
+        "--keepalive",
+        help="Frames equal to the previously sent one are not sent to the clients unless this many seconds elapsed. 0 sends all frames.",
+        type=float,
+        nargs='?',
+        default=DEFAULT_KEEPALIVE_INTERVAL,
+    )
+    parser.add_argument(
+        "--history",
+        help="Number of the last frames kept in memory for '/history' and late joining WS clients ('/updates_ws?backlog=K'). When set, frames are acquired even if no WS client is connected.",
+        type=int,
+        nargs='?',
+        default=DEFAULT_HISTORY_SIZE,
+    )
+    parser.add_argument(
+        "-D",
+        "--device",
+        help="Oscilloscopes to be served given by serial number or 'bus:address' (cf. 'lsusb'); all the connected ones when not set. Each is accessible via '/updates_ws/<id>', '/query/<id>', '/write/<id>' etc. (ids are listed by '/devices'), the paths without id address the first one.",
+        type=str,
+        nargs='*',
+        default=[],
+    )
+    parser.add_argument(
+        "--trace",
+        help="Append timing of each frame (acquisition duration, delivery delay, size, clients) as JSON line to given file.",
+        type=str,
+        nargs='?',
+        default=None,
+    )
+    parser.add_argument(
+        "--query-ttl",
+        help="Seconds '/query' responses matching regular expression are cached for, e.g. ':CH1:.*=5'; takes precedence over the defaults (0 disables caching of the matching queries): " + ', '.join(f"{p}={t}" for p, t in DEFAULT_QUERY_TTLS),
+        type=str,
+        nargs='*',
+        default=[],
+    )
     return parser
 
+def parse_query_ttl(arg: str) -> tuple:
+    '''
+    'regular expression=seconds' -> (regular expression, seconds)
+    '''
+    pattern, _, ttl = arg.rpartition('=')
+    return pattern, float(ttl)
+
 if __name__ == "__main__":
     parser = build_parser()
     pargs = parser.parse_args(sys.argv[1:])
-    app = OsciRelayApp()
-    asyncio.run(app.start(pargs.port))
+    app = OsciRelayApp(selectors=[parse_device_selector(d) for d in pargs.device])
+    asyncio.run(app.start(pargs.port, ACQ_MODES(pargs.mode), pargs.queue_size, SEND_POLICIES(pargs.send_policy), pargs.header_poll, pargs.history, pargs.trace,
+        [parse_query_ttl(a) for a in pargs.query_ttl] + list(DEFAULT_QUERY_TTLS), pargs.max_poll_interval, pargs.keepalive))
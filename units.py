@@ -1,4 +1,7 @@
+import functools
 
+# header holds only few distinct scales ... their conversions are memoized
+@functools.lru_cache(maxsize=256)
 def scale_to_float(scale: str) -> float:
     if scale.endswith('uV'):
         return float(scale.strip('uV'))/1000000
@@ -9,6 +12,7 @@ def scale_to_float(scale: str) -> float:
     else:
         raise Exception(f"unimplemented scale {scale}")
 
+@functools.lru_cache(maxsize=256)
 def float_to_scale(num: float) -> str:
     if num >= 1:
         return f"{num}V"
@@ -18,3 +22,13 @@ def float_to_scale(num: float) -> str:
         return f"{num/1000000}uV"
     else:
         raise Exception(f"unimplemented scale {num}")
+
+@functools.lru_cache(maxsize=256)
+def time_scale_to_float(scale: str) -> float:
+    '''
+    e.g. TIMEBASE SCALE '200us' -> 0.0002 (seconds)
+    '''
+    for unit, mult in (('ns', 1e-9), ('us', 1e-6), ('ms', 1e-3), ('s', 1)):
+        if scale.endswith(unit):
+            return float(scale[:-len(unit)])*mult
+    raise Exception(f"unimplemented time scale {scale}")